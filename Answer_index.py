@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+
+import numpy as np
+
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", "0.95"))
+
+
+def rubric_fingerprint(rubric):
+    """Stable key for a rubric dict; grading is only reused under the same rubric."""
+    return hashlib.md5(json.dumps(list(rubric.items())).encode("utf-8")).hexdigest()
+
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def embed_answers(answers):
+    """Normalized MPNet embeddings of `answers`, loading the model in this process."""
+    from Generative_models import get_sentence_model
+    return get_sentence_model().encode(list(answers), normalize_embeddings=True)
+
+
+@dataclass
+class IndexMatch:
+    similarity: float
+    answer: str
+    segments: OrderedDict
+    scores: dict
+    exact: bool
+
+
+class AnswerIndex:
+    """
+    Index of already-graded answers for reusing segments and scores.
+
+    Exact duplicates (after whitespace/case normalisation) are found by hash
+    without running any model. Otherwise the answer is embedded with the same
+    MPNet model as extract_relevant_passages_2 and looked up with random-
+    hyperplane LSH (`n_tables` tables of `n_planes` bits); candidates from
+    matching buckets are re-checked with exact cosine similarity against
+    `threshold`. `embed_fn(answers)` computes the embeddings; pass
+    Grading_client.embed_answers to keep MPNet in the grading server.
+    """
+
+    def __init__(self, threshold=DUPLICATE_THRESHOLD, n_planes=8, n_tables=8, seed=0, embed_fn=None):
+        self.threshold = threshold
+        self.embed_fn = embed_fn or embed_answers
+        self.n_planes = n_planes
+        self.n_tables = n_tables
+        self._rng = np.random.default_rng(seed)
+        self._planes = None  # (n_tables, n_planes, dim), created on first embedding
+        self._lock = threading.Lock()
+        self._entries = []  # (rubric_key, answer, embedding, segments, scores)
+        self._exact = {}  # (rubric_key, normalized answer hash) -> entry id
+        self._reused = set()  # text keys of answers last served from the index
+        self._buckets = defaultdict(list)  # (rubric_key, table, signature) -> entry ids
+        self.lookups = 0
+        self.exact_hits = 0
+        self.near_hits = 0
+
+    def _embed(self, answer):
+        return np.asarray(self.embed_fn([answer]), dtype=np.float32).reshape(-1)
+
+    def _signatures(self, embedding):
+        if self._planes is None:
+            self._planes = self._rng.standard_normal((self.n_tables, self.n_planes, embedding.shape[0])).astype(np.float32)
+        bits = (self._planes @ embedding) > 0  # (n_tables, n_planes)
+        weights = 1 << np.arange(self.n_planes)
+        return (bits * weights).sum(axis=1).tolist()
+
+    @staticmethod
+    def answer_key(answer):
+        """Hash of the whitespace/case-normalised answer; equal for exact duplicates."""
+        return hashlib.md5(_normalize(answer).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def _text_key(cls, rubric_key, answer):
+        return rubric_key, cls.answer_key(answer)
+
+    def lookup(self, answer, rubric):
+        """
+        Returns (match, embedding). `match` is an IndexMatch for the most
+        similar graded answer under the same rubric with cosine similarity
+        >= threshold, else None. `embedding` is the one computed for the
+        lookup (None for exact hits) so `add()` can reuse it.
+        """
+        rubric_key = rubric_fingerprint(rubric)
+        with self._lock:
+            self.lookups += 1
+            text_key = self._text_key(rubric_key, answer)
+            entry_id = self._exact.get(text_key)
+            if entry_id is not None:
+                self.exact_hits += 1
+                self._reused.add(text_key)
+                return self._match(entry_id, 1.0, exact=True), None
+
+        embedding = self._embed(answer)
+        with self._lock:
+            candidates = set()
+            for table, signature in enumerate(self._signatures(embedding)):
+                candidates.update(self._buckets.get((rubric_key, table, signature), ()))
+            best_id, best_sim = None, -1.0
+            for entry_id in candidates:
+                sim = float(self._entries[entry_id][2] @ embedding)
+                if sim > best_sim:
+                    best_id, best_sim = entry_id, sim
+            if best_id is not None and best_sim >= self.threshold:
+                self.near_hits += 1
+                self._reused.add(text_key)
+                return self._match(best_id, best_sim, exact=False), embedding
+        return None, embedding
+
+    def _match(self, entry_id, similarity, exact):
+        _, answer, _, segments, scores = self._entries[entry_id]
+        return IndexMatch(similarity, answer, OrderedDict(segments), dict(scores), exact)
+
+    def add(self, answer, rubric, segments, scores, embedding=None):
+        """Index a graded answer so later similar answers can reuse its results."""
+        rubric_key = rubric_fingerprint(rubric)
+        if embedding is None:
+            embedding = self._embed(answer)
+        with self._lock:
+            entry_id = len(self._entries)
+            self._entries.append((rubric_key, answer, embedding, OrderedDict(segments), dict(scores)))
+            text_key = self._text_key(rubric_key, answer)
+            self._exact[text_key] = entry_id
+            self._reused.discard(text_key)
+            for table, signature in enumerate(self._signatures(embedding)):
+                self._buckets[(rubric_key, table, signature)].append(entry_id)
+
+    def is_reused(self, answer, rubric):
+        """True if `answer`'s current segments and scores came from the index rather than the models."""
+        with self._lock:
+            return self._text_key(rubric_fingerprint(rubric), answer) in self._reused
+
+    def wrap(self, process_fn):
+        """
+        Wraps a `process_fn(answer, rubric, endpoint=...)` (e.g.
+        Automations.process_answer) so near-duplicates reuse indexed results
+        instead of calling the models.
+        """
+        def process_with_reuse(answer, rubric, endpoint='groq'):
+            match, embedding = self.lookup(answer, rubric)
+            if match is not None:
+                return match.segments, match.scores
+            segments, scores = process_fn(answer, rubric, endpoint=endpoint)
+            self.add(answer, rubric, segments, scores, embedding=embedding)
+            return segments, scores
+        return process_with_reuse
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            hits = self.exact_hits + self.near_hits
+            return {
+                "indexed": len(self._entries),
+                "lookups": self.lookups,
+                "exact_hits": self.exact_hits,
+                "near_hits": self.near_hits,
+                "reuse_rate": hits / self.lookups if self.lookups else 0.0,
+                "threshold": self.threshold,
+            }
+
+    def report(self):
+        s = self.stats()
+        return (
+            f"Reused {s['exact_hits'] + s['near_hits']} of {s['lookups']} answers "
+            f"({100 * s['reuse_rate']:.0f}%; {s['exact_hits']} exact, {s['near_hits']} near-duplicate "
+            f"at similarity >= {s['threshold']}), {s['indexed']} answers indexed."
+        )
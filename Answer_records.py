@@ -0,0 +1,227 @@
+import json
+import math
+import struct
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+
+# Per-criterion flags
+NOT_ADDRESSED = 1
+NOT_VERBATIM = 2  # segment is not a contiguous span of the answer; its text is kept in `texts`
+NO_SCORE = 4
+
+_HEADER = struct.Struct("<HI")  # answer_id length, criteria count
+_LENGTH = struct.Struct("<I")
+
+
+class CriterionTable:
+    """
+    Interns rubric criterion texts to small integer IDs.
+
+    Each distinct criterion is stored once; records, widget keys and lookups
+    use the ID instead of hashing or comparing the full text again.
+    """
+
+    def __init__(self, texts=()):
+        self._ids = {}
+        self._texts = []
+        self._lock = threading.Lock()
+        for text in texts:
+            self.intern(text)
+
+    def intern(self, text):
+        criterion_id = self._ids.get(text)
+        if criterion_id is None:
+            with self._lock:
+                criterion_id = self._ids.setdefault(text, len(self._texts))
+                if criterion_id == len(self._texts):
+                    self._texts.append(text)
+        return criterion_id
+
+    def ids(self, rubric):
+        """Criterion IDs of a rubric, in rubric order."""
+        return array("I", (self.intern(c) for c in rubric))
+
+    def text(self, criterion_id):
+        return self._texts[criterion_id]
+
+    def __len__(self):
+        return len(self._texts)
+
+    def to_list(self):
+        return list(self._texts)
+
+
+class AnswerRecord:
+    """
+    Segmentation and scoring result of one answer, stored column-wise.
+
+    For criterion i (rubric order): criteria[i] is its interned ID,
+    spans[2i:2i+2] the (start, end) character offsets of its segment in the
+    answer (-1, -1 when there is none), scores[i] the tentative score (NaN if
+    missing) and flags[i] a NOT_ADDRESSED / NOT_VERBATIM / NO_SCORE bitmask.
+    Segment texts are only stored for segments that are not a verbatim span.
+    """
+
+    __slots__ = ("answer_id", "criteria", "spans", "scores", "flags", "texts")
+
+    def __init__(self, answer_id, criteria, spans, scores, flags, texts=None):
+        self.answer_id = answer_id
+        self.criteria = criteria
+        self.spans = spans
+        self.scores = scores
+        self.flags = flags
+        self.texts = texts  # {criterion index: segment text} or None
+
+    @classmethod
+    def from_results(cls, answer_id, answer, rubric, segments, scores, table):
+        """Build a record from parse_answer_segments / parse_tentative_scores output."""
+        criteria = table.ids(rubric)
+        spans = array("i")
+        values = array("f")
+        flags = bytearray(len(criteria))
+        texts = None
+        for i, criterion in enumerate(rubric):
+            segment = (segments or {}).get(criterion)
+            start = -1
+            if not segment or segment.lower().startswith("not addressed"):
+                flags[i] |= NOT_ADDRESSED
+            else:
+                start = answer.find(segment)
+                if start < 0:
+                    flags[i] |= NOT_VERBATIM
+                    texts = texts or {}
+                    texts[i] = segment
+            spans.extend((start, start + len(segment)) if start >= 0 else (-1, -1))
+            score = (scores or {}).get(criterion)
+            if score is None:
+                flags[i] |= NO_SCORE
+                values.append(math.nan)
+            else:
+                values.append(score)
+        return cls(answer_id, criteria, spans, values, bytes(flags), texts)
+
+    def segment(self, i, answer):
+        if self.flags[i] & NOT_ADDRESSED:
+            return "Not addressed"
+        if self.flags[i] & NOT_VERBATIM:
+            return self.texts[i]
+        return answer[self.spans[2 * i]:self.spans[2 * i + 1]]
+
+    def segments(self, answer, table):
+        """OrderedDict {criterion text: segment}, as parse_answer_segments returns."""
+        return OrderedDict((table.text(c), self.segment(i, answer)) for i, c in enumerate(self.criteria))
+
+    def score_dict(self, table):
+        """{criterion text: score}, as parse_tentative_scores returns."""
+        # scores are float32; rounding restores the decimal value the parser read
+        return {table.text(c): round(s, 4) for c, s, f in zip(self.criteria, self.scores, self.flags) if not f & NO_SCORE}
+
+    def total(self):
+        return round(sum(s for s, f in zip(self.scores, self.flags) if not f & NO_SCORE), 4)
+
+    def to_bytes(self):
+        answer_id = str(self.answer_id).encode("utf-8")
+        texts = json.dumps(self.texts).encode("utf-8") if self.texts else b""
+        return b"".join([
+            _HEADER.pack(len(answer_id), len(self.criteria)),
+            answer_id,
+            self.criteria.tobytes(),
+            self.spans.tobytes(),
+            self.scores.tobytes(),
+            self.flags,
+            _LENGTH.pack(len(texts)),
+            texts,
+        ])
+
+    @classmethod
+    def from_bytes(cls, data):
+        id_len, n = _HEADER.unpack_from(data)
+        pos = _HEADER.size
+        answer_id = data[pos:pos + id_len].decode("utf-8")
+        pos += id_len
+        criteria, spans, scores = array("I"), array("i"), array("f")
+        for arr, count in ((criteria, n), (spans, 2 * n), (scores, n)):
+            size = count * arr.itemsize
+            arr.frombytes(data[pos:pos + size])
+            pos += size
+        flags = bytes(data[pos:pos + n])
+        pos += n
+        (texts_len,) = _LENGTH.unpack_from(data, pos)
+        pos += _LENGTH.size
+        texts = {int(k): v for k, v in json.loads(data[pos:pos + texts_len]).items()} if texts_len else None
+        return cls(answer_id, criteria, spans, scores, flags, texts)
+
+
+def write_records(path, records, table):
+    """Write the criterion table and length-prefixed records; `records` may be a generator."""
+    with open(path, "wb") as f:
+        f.write(json.dumps(table.to_list()).encode("utf-8") + b"\n")
+        count = 0
+        for record in records:
+            blob = record.to_bytes()
+            f.write(_LENGTH.pack(len(blob)))
+            f.write(blob)
+            count += 1
+    return count
+
+
+def read_records(path):
+    """Returns (CriterionTable, generator of AnswerRecord) for a file written by write_records."""
+    f = open(path, "rb")
+    table = CriterionTable(json.loads(f.readline()))
+
+    def records():
+        with f:
+            while True:
+                prefix = f.read(_LENGTH.size)
+                if not prefix:
+                    return
+                yield AnswerRecord.from_bytes(f.read(_LENGTH.unpack(prefix)[0]))
+    return table, records()
+
+
+if __name__ == "__main__":
+    # python Answer_records.py [n]: memory of n results as dicts vs records
+    import random
+    import tracemalloc
+    from Stub_llm import synthesize_scores, synthesize_segments
+    from Parsers import parse_answer_segments, parse_tentative_scores
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rubric = {
+        "Defines generative AI": 3,
+        "Describes key technologies": 3,
+        "Discusses applications and ethical concerns": 4,
+    }
+    sentences = [
+        "Generative AI produces text, images and audio from patterns learned from data.",
+        "Large language models and diffusion models are the key technologies.",
+        "It is used in healthcare, media and programming.",
+        "Deepfakes and privacy are major ethical concerns.",
+    ]
+    answers = [" ".join(random.Random(i).sample(sentences, 3)) for i in range(n)]
+    responses = []
+    for answer in answers:
+        raw_segments = synthesize_segments(answer, rubric)
+        responses.append((raw_segments, synthesize_scores(rubric, parse_answer_segments(raw_segments))))
+
+    # what a batch holds today: the parsers' string-keyed dicts per answer
+    tracemalloc.start()
+    parsed = [(parse_answer_segments(s), parse_tentative_scores(sc)) for s, sc in responses]
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    table = CriterionTable()
+    records = [AnswerRecord.from_results(i, a, rubric, s, sc, table) for i, (a, (s, sc)) in enumerate(zip(answers, parsed))]
+    record_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    assert all(r.segments(a, table) == s and r.score_dict(table) == sc for r, a, (s, sc) in zip(records, answers, parsed))
+    blob = sum(len(r.to_bytes()) for r in records)
+    print(f"{n} answers x {len(rubric)} criteria")
+    print(f"  dicts   : {dict_bytes / n:,.0f} bytes per answer")
+    print(f"  records : {record_bytes / n:,.0f} bytes per answer ({dict_bytes / record_bytes:.1f}x smaller)")
+    print(f"  serialized: {blob / n:,.0f} bytes per answer")
@@ -8,13 +8,29 @@ try:
 except LookupError:
     nltk.download("punkt", quiet=True)
 
-import hashlib
-from Automations import (
-    generate_rubric_2,
-    break_answer_into_points,
-    suggest_rubric_modification,
-    ai_grade_segments,
-)
+import os
+import functools
+import tempfile
+# With GRADING_SERVER_URL set the app is a thin client of Grading_server.py
+# (one shared copy of each model); otherwise models run in this process.
+if os.getenv("GRADING_SERVER_URL"):
+    import Grading_client as grading_backend
+    embed_answers = grading_backend.embed_answers  # near-duplicate embeddings stay on the server too
+else:
+    import Automations as grading_backend
+    embed_answers = None  # AnswerIndex loads MPNet in this process
+generate_rubric_2 = grading_backend.generate_rubric_2
+break_answer_into_points = grading_backend.break_answer_into_points
+suggest_rubric_modification = grading_backend.suggest_rubric_modification
+ai_grade_segments = grading_backend.ai_grade_segments
+generate_rubric_consensus = grading_backend.generate_rubric_consensus
+from Prefetch import AnswerPrefetcher
+from Answer_index import AnswerIndex, DUPLICATE_THRESHOLD
+from Answer_records import CriterionTable
+from Score_calibration import record_final_scores, iter_records, OVERRIDES_PATH
+from Exporters import export_results, rows_from_saved_scores
+from Token_budget import ledger
+import Tracing
 from Parsers import parse_rubric, parse_answer_segments, parse_tentative_scores
 
 # --- Page Config ---
@@ -31,10 +47,11 @@ st.title("🤖 AI-Assisted Grading Tool(Smart Grading Assistant)")
 # )
 
 # --- Helpers ---
-def _safe_key(text: str):
-    """Create a short stable key for session_state from arbitrary text."""
-    return hashlib.md5(text.encode("utf-8")).hexdigest()[:10]
+def _criterion_key(text: str):
+    """Short stable widget key for a rubric criterion: its interned ID for this session."""
+    return st.session_state.criteria.intern(text)
 
+@Tracing.traced()
 def highlight_sentence_wise(full_answer: str, extracted_segment: str):
     """
     Highlight each matching sentence from extracted_segment individually
@@ -68,6 +85,27 @@ def highlight_sentence_wise(full_answer: str, extracted_segment: str):
 
     return f"<pre style='white-space: pre-wrap; font-family: inherit;'>{highlighted}</pre>"
 
+def _load_processed_answer(answer: str, segments, scores, scores_source=None):
+    """
+    Make a processed answer the one under review, clearing per-criterion score widgets.
+    `scores_source` is the scoring endpoint, or 'reused' for near-duplicate reuse.
+    """
+    for key in [k for k in st.session_state.keys() if str(k).startswith("score_")]:
+        del st.session_state[key]
+    st.session_state.full_answer = answer
+    st.session_state.segments = segments
+    st.session_state.ai_suggestions = scores if isinstance(scores, dict) else {}
+    st.session_state.active_highlight = None
+    st.session_state.scores_source = scores_source or st.session_state.get("scoring_choice", "groq")
+
+# On air-gapped graders, report missing local checkpoints up front
+if grading_backend.__name__ == "Automations" and os.getenv("GRADER_OFFLINE", "0") == "1":
+    from Generative_models import verify_local_models
+    if 'offline_problems' not in st.session_state:
+        st.session_state.offline_problems = verify_local_models()
+    for label, problem in st.session_state.offline_problems.items():
+        st.warning(f"Offline mode: the {label} endpoint is unavailable ({problem}).")
+
 # --- Session State Initialization ---
 if 'rubric' not in st.session_state:
     st.session_state.rubric = None  # dict: {criterion_text: marks}
@@ -85,6 +123,23 @@ if 'ai_suggestions' not in st.session_state:
     st.session_state.ai_suggestions = {}
 if 'use_ai_scores' not in st.session_state:
     st.session_state.use_ai_scores = True
+if 'prefetcher' not in st.session_state:
+    st.session_state.prefetcher = None  # AnswerPrefetcher for queue mode
+if 'queue_position' not in st.session_state:
+    st.session_state.queue_position = 0
+if 'criteria' not in st.session_state:
+    st.session_state.criteria = CriterionTable()  # criterion text -> ID for widget keys
+if 'answer_index' not in st.session_state:
+    st.session_state.answer_index = None  # AnswerIndex of graded answers for near-duplicate reuse
+
+# Tracing toggle lives at the top so it applies to this run; results render at the bottom.
+# It traces this session only, into its own collector (GRADER_TRACE=1 traces the whole process).
+if 'trace_collector' not in st.session_state:
+    st.session_state.trace_collector = Tracing.TraceCollector()
+trace_panel = st.sidebar.expander("Pipeline tracing (debug)", expanded=False)
+with trace_panel:
+    trace_on = st.checkbox("Enable tracing for this session", value=False, key="trace_toggle")
+    Tracing.use_collector(st.session_state.trace_collector if trace_on else None)
 
 # --- CSS Styling (from App4 + minor tweaks) ---
 st.markdown(
@@ -152,6 +207,11 @@ with col1:
     # --- MODIFICATION END ---
 with col2:
     marks = st.number_input("Maximum Marks:", min_value=1, value=10)
+    rubric_candidates = st.number_input(
+        "Rubric candidates:", min_value=1, max_value=8, value=1,
+        help="Generate several rubrics in parallel, validate them and keep the most consistent one.",
+    )
+    merge_candidates = st.checkbox("Merge into consensus rubric", value=False, disabled=rubric_candidates < 2)
 
 if st.button("Generate Rubric", type="primary", use_container_width=True):
     if question and marks:
@@ -159,9 +219,15 @@ if st.button("Generate Rubric", type="primary", use_container_width=True):
             with st.spinner("Generating rubric..."):
                 # --- MODIFICATION START ---
                 # Pass the new demo_answers text to the function
-                raw_rubric = generate_rubric_2(question, marks, demo_answers, endpoint='groq')
+                if rubric_candidates > 1:
+                    raw_rubric, parsed_rubric, consensus_report = generate_rubric_consensus(
+                        question, marks, demo_answers, n=int(rubric_candidates), merge=merge_candidates, endpoint='groq'
+                    )
+                    st.caption(f"{consensus_report['valid']} of {consensus_report['candidates']} rubric candidates passed validation.")
+                else:
+                    raw_rubric = generate_rubric_2(question, marks, demo_answers, endpoint='groq')
+                    parsed_rubric = parse_rubric(raw_rubric)
                 # --- MODIFICATION END ---
-                parsed_rubric = parse_rubric(raw_rubric)
             if not parsed_rubric:
                 st.error("AI failed to generate a rubric in the expected format. Check LLM output.")
             else:
@@ -232,7 +298,8 @@ if st.session_state.rubric:
                                 st.session_state.full_answer,
                                 st.session_state.rubric,
                                 parsed_segments,
-                                endpoint=st.session_state.get("endpoint_choice", "groq"),
+                                endpoint=st.session_state.get("scoring_choice", "groq"),
+                                question=question,
                             )
                             # ai_grade_segments might return a dict or raw string; try to handle both
                             if isinstance(ai_out, dict):
@@ -258,51 +325,155 @@ if st.session_state.rubric:
     # endpoint choice
     endpoint_choice = st.radio(
         "Select the model for answer processing:",
-        ('groq', 'deberta', 'embedding_model'),
+        ('groq', 'deberta', 'embedding_model', 'embedding_rerank'),
         index=0,
         horizontal=True,
-        help="Groq is faster. DeBERTa might be better for QA-style extraction. embedding_model uses sentence embeddings."
+        help="Groq is faster. DeBERTa might be better for QA-style extraction. embedding_model uses sentence embeddings. embedding_rerank reranks the embedding candidates with a cross-encoder."
     )
     st.session_state.endpoint_choice = endpoint_choice
 
+    scoring_choice = st.radio(
+        "Select the model for tentative scores:",
+        ('groq', 'local'),
+        index=0,
+        horizontal=True,
+        help="local uses a calibration model fitted on your saved final scores (run `python Score_calibration.py` to fit and evaluate it); no LLM call.",
+    )
+    st.session_state.scoring_choice = scoring_choice
+
     answer = st.text_area("Paste the student's answer here:", height=200, placeholder="The student's full answer...")
+    st.session_state.student_id = st.text_input("Student ID (optional, used when saving and exporting scores)", value=st.session_state.get("student_id", ""))
     use_ai = st.checkbox("Use AI's tentative marks as initial grades", value=True, key="use_ai_toggle")
     st.session_state.use_ai_scores = use_ai
 
+    col_r1, col_r2 = st.columns([2, 1])
+    with col_r1:
+        reuse_duplicates = st.checkbox(
+            "Reuse grading for near-duplicate answers",
+            value=False,
+            help="Answers very similar to one already processed (under the same rubric) reuse its segments and scores without calling the models.",
+        )
+    with col_r2:
+        duplicate_threshold = st.slider("Similarity threshold", 0.80, 1.00, DUPLICATE_THRESHOLD, 0.01, disabled=not reuse_duplicates)
+    if reuse_duplicates:
+        if st.session_state.answer_index is None:
+            st.session_state.answer_index = AnswerIndex(threshold=duplicate_threshold, embed_fn=embed_answers)
+        st.session_state.answer_index.threshold = duplicate_threshold
+    reuse_summary = st.empty()  # filled in after this run's lookups, below the queue
+    process_fn = functools.partial(grading_backend.process_answer, scoring_endpoint=scoring_choice, question=question)
+    if reuse_duplicates:
+        process_fn = st.session_state.answer_index.wrap(process_fn)
+
     if st.button("Process Answer & Get AI Suggestions", type="primary", use_container_width=True):
         if not answer:
             st.warning("Please paste the student's answer.")
         else:
             try:
                 st.session_state.full_answer = answer
-                with st.spinner(f"Breaking down the answer using {endpoint_choice}..."):
-                    raw_segments = break_answer_into_points(
-                        answer,
-                        parse_rubric(st.session_state.raw_rubric_text) if st.session_state.raw_rubric_text else st.session_state.rubric,
-                        endpoint=endpoint_choice,
-                    )
-                    parsed_segments = parse_answer_segments(raw_segments)
-                    st.session_state.segments = parsed_segments
+                match, answer_embedding = None, None
+                if reuse_duplicates:
+                    match, answer_embedding = st.session_state.answer_index.lookup(answer, st.session_state.rubric)
+                if match is not None:
+                    _load_processed_answer(answer, match.segments, match.scores, scores_source='reused')
+                    st.success(f"Reused grading from a previous answer (similarity {match.similarity:.2f}).")
+                else:
+                    with st.spinner(f"Breaking down the answer using {endpoint_choice}..."):
+                        raw_segments = break_answer_into_points(
+                            answer,
+                            parse_rubric(st.session_state.raw_rubric_text) if st.session_state.raw_rubric_text else st.session_state.rubric,
+                            endpoint=endpoint_choice,
+                        )
+                        parsed_segments = parse_answer_segments(raw_segments)
+                        st.session_state.segments = parsed_segments
+
+                    # Get tentative AI grades
+                    with st.spinner("Getting tentative AI grades..."):
+                        ai_out = ai_grade_segments(
+                            answer,
+                            st.session_state.rubric,
+                            parsed_segments,
+                            endpoint=scoring_choice,
+                            question=question,
+                        )
+                        if isinstance(ai_out, dict):
+                            st.session_state.ai_suggestions = ai_out
+                        else:
+                            try:
+                                st.session_state.ai_suggestions = parse_tentative_scores(ai_out)
+                            except Exception:
+                                st.session_state.ai_suggestions = {}
+                    st.session_state.scores_source = scoring_choice
+                    if reuse_duplicates:
+                        st.session_state.answer_index.add(
+                            answer, st.session_state.rubric, parsed_segments, st.session_state.ai_suggestions,
+                            embedding=answer_embedding,
+                        )
+                    st.success("Answer processed and AI suggestions ready.")
+            except Exception as e:
+                st.error(f"An error occurred: {e}")
+                st.exception(e)
 
-                # Get tentative AI grades
-                with st.spinner("Getting tentative AI grades..."):
-                    ai_out = ai_grade_segments(
-                        answer,
+    # --- Queue mode: prefetch the next answers while the current one is reviewed ---
+    with st.expander("Grade a queue of answers", expanded=st.session_state.prefetcher is not None):
+        queued_text = st.text_area(
+            "Paste several answers, separated by a line containing only ---",
+            height=200,
+            key="queued_answers",
+        )
+        prefetch_depth = st.slider("Answers to prepare ahead", min_value=1, max_value=5, value=2)
+        col_q1, col_q2 = st.columns(2)
+        with col_q1:
+            if st.button("Start queue", use_container_width=True):
+                queued = [a.strip() for a in re.split(r"\n\s*---\s*\n", queued_text) if a.strip()]
+                if not queued:
+                    st.warning("Please paste at least one answer.")
+                else:
+                    if st.session_state.prefetcher is not None:
+                        st.session_state.prefetcher.stop()
+                    # Same (possibly edited) rubric the grade panel and scoring use
+                    st.session_state.prefetcher = AnswerPrefetcher(
+                        queued,
                         st.session_state.rubric,
-                        parsed_segments,
                         endpoint=endpoint_choice,
+                        depth=prefetch_depth,
+                        process_fn=process_fn,
                     )
-                    if isinstance(ai_out, dict):
-                        st.session_state.ai_suggestions = ai_out
+                    st.session_state.queue_position = 0
+        with col_q2:
+            next_clicked = st.button(
+                "Next answer",
+                use_container_width=True,
+                disabled=st.session_state.prefetcher is None,
+            )
+
+        prefetcher = st.session_state.prefetcher
+        if prefetcher is not None and prefetcher.rubric != dict(st.session_state.rubric):
+            prefetcher = st.session_state.prefetcher = prefetcher.restarted(st.session_state.rubric)
+            st.info("The rubric changed: the remaining queued answers are being prepared again with the edited rubric.")
+        if prefetcher is not None:
+            if next_clicked:
+                with st.spinner("Waiting for the next answer..."):
+                    item = prefetcher.next()
+                if item is None:
+                    st.session_state.prefetcher = None
+                    st.success("Queue finished.")
+                else:
+                    st.session_state.queue_position = item.index + 1
+                    if item.error is not None:
+                        st.error(f"Answer {item.index + 1} failed: {item.error}. Click Next answer to skip it.")
                     else:
-                        try:
-                            st.session_state.ai_suggestions = parse_tentative_scores(ai_out)
-                        except Exception:
-                            st.session_state.ai_suggestions = {}
-                st.success("Answer processed and AI suggestions ready.")
-            except Exception as e:
-                st.error(f"An error occurred: {e}")
-                st.exception(e)
+                        index = st.session_state.answer_index
+                        reused = reuse_duplicates and index is not None and index.is_reused(item.answer, prefetcher.rubric)
+                        _load_processed_answer(item.answer, item.segments, item.scores, scores_source='reused' if reused else None)
+                        st.rerun()
+            else:
+                st.caption(
+                    f"Reviewing answer {st.session_state.queue_position} of {len(prefetcher)} "
+                    f"· {prefetcher.ready()} prepared ahead"
+                )
+
+    if reuse_duplicates:
+        reuse_summary.caption(st.session_state.answer_index.report())
 
 # --- Step 3: Grade Breakdown (show extracted part + highlight + scores) ---
 if st.session_state.segments:
@@ -333,6 +504,7 @@ if st.session_state.segments:
 
     # Grading panel
     total_score = 0.0
+    final_scores = {}
     max_marks_total = st.session_state.total_max_marks
     total_score_placeholder = st.empty()
 
@@ -347,7 +519,7 @@ if st.session_state.segments:
                 st.info(f"**AI-extracted answer part:**\n\n{segment_text}")
 
                 # Highlight button toggles this rubric's highlight in full answer
-                if st.button("Highlight Relevant Part", key=f"highlight_btn_{_safe_key(rubric_point)}"):
+                if st.button("Highlight Relevant Part", key=f"highlight_btn_{_criterion_key(rubric_point)}"):
                     # toggle the active highlight
                     st.session_state.active_highlight = (
                         None if st.session_state.active_highlight == rubric_point else rubric_point
@@ -361,7 +533,7 @@ if st.session_state.segments:
 
             with col_right:
                 # prepare score key
-                score_key = f"score_{_safe_key(rubric_point)}"
+                score_key = f"score_{_criterion_key(rubric_point)}"
                 # initialize session state for score if not present
                 if score_key not in st.session_state:
                     # If use_ai_scores is True and ai has suggestion, prefill; else 0.0
@@ -379,10 +551,29 @@ if st.session_state.segments:
                 # persist selected score in session_state (number_input already does)
                 # st.session_state[score_key] = score
                 total_score += float(score)
+                final_scores[rubric_point] = float(score)
 
     # show total
     total_score_placeholder.metric("TOTAL SCORE", f"{total_score} / {max_marks_total}", delta_color="off")
 
+    # Final scores feed the local scoring model (Score_calibration.py)
+    if st.button("💾 Save final scores"):
+        try:
+            record_final_scores(
+                question,
+                st.session_state.rubric,
+                full_answer_text,
+                st.session_state.segments,
+                st.session_state.ai_suggestions,
+                final_scores,
+                endpoint=st.session_state.get("endpoint_choice", "groq"),
+                scoring_endpoint=st.session_state.get("scores_source", st.session_state.get("scoring_choice", "groq")),
+                student_id=st.session_state.get("student_id") or None,
+            )
+            st.success("Final scores saved.")
+        except Exception as e:
+            st.error(f"Could not save scores: {e}")
+
 # --- Step 4: AI-Suggested Rubric Modification (from App4) ---
 if 'rubric_suggestion' not in st.session_state:
     st.session_state.rubric_suggestion = None
@@ -436,5 +627,51 @@ if st.session_state.rubric and st.session_state.full_answer:
                         st.success("Suggested rubric modification added. Please review/edit if needed.")
                         st.rerun()
 
-# --- Footer / Save / Export suggestion ---
-st.divider()
\ No newline at end of file
+# --- Sidebar: LLM token usage (process-wide) ---
+with st.sidebar.expander("LLM token usage", expanded=False):
+    if hasattr(grading_backend, "usage_report"):
+        try:
+            st.code(grading_backend.usage_report(), language=None)
+        except Exception as e:
+            st.caption(f"Could not fetch usage from grading server: {e}")
+    else:
+        st.code(ledger.report(), language=None)
+    if not hasattr(grading_backend, "usage_report") and st.button("Reset usage counters"):
+        ledger.reset()
+        st.rerun()
+
+# --- Sidebar: pipeline tracing debug panel ---
+with trace_panel:
+    trace_summary = st.session_state.trace_collector.summary()
+    if trace_summary:
+        st.dataframe(
+            [{"span": name, **{k: round(v, 4) if isinstance(v, float) else v for k, v in stats.items()}}
+             for name, stats in sorted(trace_summary.items(), key=lambda kv: -kv[1]["wall_s"])],
+            use_container_width=True,
+        )
+        st.download_button("Download JSON", st.session_state.trace_collector.to_json(), file_name="trace.json")
+        st.download_button("Download Chrome trace", st.session_state.trace_collector.to_chrome_trace(), file_name="trace.chrome.json")
+        if st.button("Clear trace"):
+            st.session_state.trace_collector.clear()
+            st.rerun()
+    elif trace_on:
+        st.caption("No spans recorded yet.")
+
+# --- Footer / Save / Export ---
+st.divider()
+with st.expander("Export saved final scores"):
+    st.caption(f"One row per student and criterion from `{OVERRIDES_PATH}` (also: `python Exporters.py` / `python Exam.py exam.json --export`).")
+    export_format = st.radio("Format", ("csv", "parquet", "arrow"), horizontal=True)
+    if st.button("Prepare export"):
+        try:
+            with tempfile.NamedTemporaryFile(suffix=f".{export_format}", delete=False) as tmp:
+                path = tmp.name
+            n_rows = export_results(rows_from_saved_scores(iter_records(OVERRIDES_PATH)), path, fmt=export_format)
+            with open(path, "rb") as f:
+                st.session_state.export_file = (f.read(), f"graded_results.{export_format}", n_rows)
+            os.remove(path)
+        except Exception as e:
+            st.error(f"Export failed: {e}")
+    if st.session_state.get("export_file"):
+        data, file_name, n_rows = st.session_state.export_file
+        st.download_button(f"Download {file_name} ({n_rows} rows)", data, file_name=file_name)
\ No newline at end of file
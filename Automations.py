@@ -1,6 +1,36 @@
-from Generative_models import use_groq,use_deberta,extract_relevant_passages,extract_relevant_passages_2
+from Generative_models import use_groq,use_stub,use_deberta,extract_relevant_passages,extract_relevant_passages_2,extract_relevant_passages_reranked
+import os
+import re
 import textwrap
-from Parsers import parse_answer_segments, parse_rubric,parse_tentative_scores
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from Parsers import parse_answer_segments, parse_rubric,parse_tentative_scores,format_rubric,word_stems
+from Token_budget import ledger, compact_text, compact_rubric, compact_segments
+from Tracing import traced
+
+# Send compacted prompts (dedented, one-line-per-criterion rubric) to the LLM.
+# Set COMPACT_PROMPTS=0 to fall back to the original verbose prompts.
+COMPACT_PROMPTS = os.getenv("COMPACT_PROMPTS", "1") != "0"
+
+
+def _select_prompt(stage, verbose_prompt, compact_prompt):
+    """Pick the prompt to send and record the tokens compaction saved for `stage`."""
+    if not COMPACT_PROMPTS:
+        return verbose_prompt
+    ledger.record_compaction(stage, verbose_prompt, compact_prompt)
+    return compact_prompt
+
+
+def _call_llm(prompt, stage, endpoint, **inputs):
+    """
+    Send `prompt` to an LLM endpoint: 'groq', or 'stub' (offline, synthesized
+    from `inputs`; see Stub_llm.py).
+    """
+    if endpoint == 'groq':
+        return use_groq(prompt, stage=stage)
+    if endpoint == 'stub':
+        return use_stub(prompt, stage=stage, **inputs)
+    raise ValueError(f'Unsupported endpoint: {endpoint}')
 
 def generate_rubric(question,marks,endpoint='groq'):
     prompt = f"""
@@ -44,10 +74,8 @@ def generate_rubric(question,marks,endpoint='groq'):
 
       Now, generate the rubric.
       """
-    if endpoint=='groq':
-        response = use_groq(prompt)
-    else:
-        raise ValueError(f'Unsupported endpoint: {endpoint}')
+    prompt = _select_prompt('rubric', prompt, compact_text(prompt))
+    response = _call_llm(prompt, 'rubric', endpoint, question=question, marks=marks)
     return response.content
 
 
@@ -102,15 +130,198 @@ def generate_rubric_2(question, marks, demo_answers="", endpoint='groq'):
     prompt = "\n".join(prompt_lines)
     # --- MODIFICATION END ---
 
-    if endpoint=='groq':
-        response = use_groq(prompt)
-    else:
-        raise ValueError(f'Unsupported endpoint: {endpoint}')
+    # Same instructions without markdown emphasis or the repeated format example
+    compact_lines = [
+        "You are an expert educational evaluator and assessment designer.",
+        f"Generate a grading rubric for this question (maximum marks: {marks}):",
+        f"\"\"\"{question.strip()}\"\"\"",
+    ]
+    if demo_answers and demo_answers.strip():
+        compact_lines.append("Exemplar answers, to identify the key concepts and expected depth:")
+        compact_lines.append(f"\"\"\"{compact_text(demo_answers)}\"\"\"")
+    compact_lines.extend([
+        "Instructions:",
+        f"- Split the rubric into clear criteria whose marks sum to {marks}; no single criterion should dominate.",
+        "- Cover the key concepts and reasoning a high-quality answer must contain; prefer conceptual evaluation over rote memorization.",
+        "- For an open-ended question, include one criterion for clarity, coherence and relevance.",
+        "- Do not repeat the question. Give only the rubric points, in this format:",
+        "<start>",
+        "Rubric: <rubric point>",
+        "Marks: <marks for the rubric point>",
+        "####",
+        "...",
+        "<end>",
+    ])
+    prompt = _select_prompt('rubric', prompt, "\n".join(compact_lines))
+    response = _call_llm(prompt, 'rubric', endpoint, question=question, marks=marks)
     return response.content
 
 
 
 
+def validate_rubric(raw_rubric, rubric, marks):
+    """
+    Checks a parsed rubric against the raw LLM output it came from.
+
+    Returns:
+        list: Problems found (empty if the rubric is usable).
+    """
+    problems = []
+    if not rubric:
+        return ["could not parse rubric (missing <start>/<end> tags or fields)"]
+    total = sum(rubric.values())
+    if total != marks:
+        problems.append(f"marks sum to {total}, expected {marks}")
+    normalized = Counter(word_stems(c) for c in rubric)
+    if any(count > 1 for count in normalized.values()):
+        problems.append("duplicate criteria")
+    # parse_rubric silently collapses repeated criteria and skips malformed points
+    body = raw_rubric[raw_rubric.find('<start>'):raw_rubric.find('<end>')]
+    if len(re.findall(r'Rubric:', body)) != len(rubric):
+        problems.append("some rubric points were duplicated or could not be parsed")
+    return problems
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def _rubric_agreement(rubric, others):
+    """Mean best-match token overlap of this rubric's criteria with each other rubric."""
+    if not others:
+        return 0.0
+    mine = [word_stems(c) for c in rubric]
+    scores = []
+    for other in others:
+        theirs = [word_stems(c) for c in other]
+        scores.append(sum(max((_jaccard(m, t) for t in theirs), default=0.0) for m in mine) / len(mine))
+    return sum(scores) / len(scores)
+
+
+def _criterion_similarity(a, b):
+    """Overlap coefficient of criterion stems, lenient to one wording being longer than the other."""
+    return len(a & b) / min(len(a), len(b)) if a and b else 0.0
+
+
+def _cluster_criteria(rubrics, match_threshold):
+    """
+    Groups equivalent criteria across all rubrics. Each cluster holds at most
+    one criterion per rubric; a criterion joins the most similar cluster
+    (average similarity to its members) above `match_threshold`.
+
+    Returns:
+        list: Clusters of (rubric index, position, criterion, marks, tokens).
+    """
+    clusters = []
+    for r, rubric in enumerate(rubrics):
+        for position, (criterion, marks) in enumerate(rubric.items()):
+            tokens = word_stems(criterion)
+            best, best_sim = None, match_threshold
+            for cluster in clusters:
+                if any(member[0] == r for member in cluster):
+                    continue
+                sim = sum(_criterion_similarity(tokens, m[4]) for m in cluster) / len(cluster)
+                if sim >= best_sim:
+                    best, best_sim = cluster, sim
+            member = (r, position, criterion, marks, tokens)
+            if best is None:
+                clusters.append([member])
+            else:
+                best.append(member)
+    return clusters
+
+
+def _allocate_marks(weights, marks):
+    """Integer marks proportional to `weights`, at least 1 each, summing to `marks` (largest remainder)."""
+    spare = marks - len(weights)
+    total = sum(weights)
+    exact = [spare * w / total if total else spare / len(weights) for w in weights]
+    allocated = [1 + int(e) for e in exact]
+    order = sorted(range(len(weights)), key=lambda i: exact[i] - int(exact[i]), reverse=True)
+    for i in order[:marks - sum(allocated)]:
+        allocated[i] += 1
+    return allocated
+
+
+def _merge_rubrics(rubrics, marks, match_threshold=0.5):
+    """
+    Consensus rubric from all candidates: equivalent criteria are clustered
+    across every candidate, clusters present in a majority of candidates are
+    kept (most-supported first if there are more than `marks`), each is named
+    by its most representative wording and weighted by its median marks,
+    rescaled to sum to `marks` with at least 1 mark per criterion.
+    """
+    clusters = [c for c in _cluster_criteria(rubrics, match_threshold) if len(c) * 2 > len(rubrics)]
+    if not clusters:
+        return {}
+    clusters.sort(key=len, reverse=True)
+    clusters = clusters[:marks]
+    # rubric order: mean position of the members within their own rubric
+    clusters.sort(key=lambda c: sum(m[1] for m in c) / len(c))
+
+    names, weights = [], []
+    for cluster in clusters:
+        medoid = max(cluster, key=lambda m: sum(_criterion_similarity(m[4], o[4]) for o in cluster))
+        names.append(medoid[2])
+        weights.append(sorted(m[3] for m in cluster)[len(cluster) // 2])
+    return dict(zip(names, _allocate_marks(weights, marks)))
+
+
+def generate_rubric_consensus(question, marks, demo_answers="", n=3, merge=False, endpoint='groq'):
+    """
+    Generates `n` rubric candidates concurrently and returns the best one.
+
+    Each candidate is validated (parseable, marks sum to `marks`, no duplicate
+    criteria). Among valid candidates the one agreeing most with the others is
+    chosen (self-consistency); with `merge=True` a consensus rubric built from
+    all valid candidates is returned instead, unless it fails validation or
+    agrees less with the candidates than that best candidate (see
+    report["merge_problems"]). If no candidate is valid, the
+    parseable candidate with the fewest problems is returned.
+
+    Returns:
+        tuple: (raw rubric text in <start>...<end> format, rubric dict, report dict)
+    """
+    def attempt(_):
+        try:
+            raw = generate_rubric_2(question, marks, demo_answers, endpoint=endpoint)
+        except Exception as e:
+            return None, {}, [f"{type(e).__name__}: {e}"]
+        rubric = parse_rubric(raw)
+        return raw, rubric, validate_rubric(raw, rubric, marks)
+
+    with ThreadPoolExecutor(max_workers=n) as executor:
+        futures = [ledger.submit(executor, attempt, i, default='rubric_consensus') for i in range(n)]
+        candidates = [f.result() for f in futures]
+
+    report = {"candidates": n, "valid": 0, "problems": [problems for _, _, problems in candidates], "merged": False}
+    valid = [(raw, rubric) for raw, rubric, problems in candidates if not problems]
+    report["valid"] = len(valid)
+
+    if valid:
+        rubrics = [rubric for _, rubric in valid]
+        agreement = [_rubric_agreement(rubrics[i], rubrics[:i] + rubrics[i + 1:]) for i in range(len(valid))]
+        best = max(range(len(valid)), key=agreement.__getitem__)
+        if merge and len(valid) > 1:
+            # Use the merge only if it is valid and agrees with the candidates
+            # at least as well as the best single candidate does
+            merged = _merge_rubrics(rubrics, marks)
+            merged_raw = format_rubric(merged)
+            report["merge_problems"] = validate_rubric(merged_raw, merged, marks)
+            if not report["merge_problems"] and _rubric_agreement(merged, rubrics) < agreement[best]:
+                report["merge_problems"].append("merged rubric agrees less with the candidates than the best candidate")
+            if not report["merge_problems"]:
+                report["merged"] = True
+                return merged_raw, merged, report
+        return valid[best][0], valid[best][1], report
+
+    parseable = [c for c in candidates if c[1]]
+    if not parseable:
+        raise ValueError(f"None of the {n} rubric candidates could be parsed: {report['problems']}")
+    raw, rubric, _ = min(parseable, key=lambda c: len(c[2]))
+    return raw, rubric, report
+
+
 def break_answer_into_points(answer, rubric, endpoint='groq'):
     """
     Classify sections of a student's answer under the given rubric criteria.
@@ -118,13 +329,13 @@ def break_answer_into_points(answer, rubric, endpoint='groq'):
     Args:
         answer (str): The student's subjective answer.
         rubric (str): The generated rubric text (from LLM).
-        endpoint (str): Which model endpoint to use ('groq' or 'gemini').
+        endpoint (str): Which model endpoint to use ('groq', 'stub', 'deberta', 'embedding_model' or 'embedding_rerank').
 
     Returns:
         str: LLM-generated structured mapping from rubric → corresponding part.
     """
 
-    classification_prompt = f"""
+    classification_template = """
     You are an expert evaluator and text analyzer.
 
     You are given:
@@ -158,29 +369,48 @@ def break_answer_into_points(answer, rubric, endpoint='groq'):
 
     Now generate the structured mapping as per the required format.
     """
+    classification_prompt = classification_template.format(rubric=rubric, answer=answer)
 
     # Clean the prompt (remove unnecessary indentation)
     prompt = textwrap.dedent(classification_prompt).strip()
 
     # Call the appropriate LLM endpoint
-    if endpoint == 'groq':
-        response = use_groq(prompt)
+    if endpoint in ('groq', 'stub'):
+        prompt = _select_prompt(
+            'segmentation',
+            prompt,
+            compact_text(classification_template).format(
+                rubric=compact_rubric(rubric, with_marks=False), answer=answer.strip()
+            ),
+        )
+        response = _call_llm(prompt, 'segmentation', endpoint, answer=answer, rubric=rubric)
     elif endpoint.lower() == 'deberta':
         # raise Exception(type(rubric))
         return use_deberta(answer, rubric)
     elif endpoint=='embedding_model':
         return extract_relevant_passages_2(answer, rubric,top_k=3)
+    elif endpoint=='embedding_rerank':
+        return extract_relevant_passages_reranked(answer, rubric, top_k=3)
     else:
-        raise ValueError("Currently only 'groq' endpoint is supported.")
+        raise ValueError(f'Unsupported endpoint: {endpoint}')
 
     return response.content
 
 
-def ai_grade_segments(answer, rubric, segments, endpoint='groq'):
+def ai_grade_segments(answer, rubric, segments, endpoint='groq', question=None):
     """
     Suggests tentative scores for each rubric point based on extracted answer segments.
     Returns a dict {rubric_point: tentative_score}.
+
+    endpoint='local' uses the calibration model fitted on instructor-final
+    scores (Score_calibration.py) instead of an LLM call; `question` selects
+    its per-question weights. endpoint='stub' scores offline (Stub_llm.py).
+    Any other endpoint scores with Groq.
     """
+    if endpoint == 'local':
+        from Score_calibration import get_calibrator
+        return get_calibrator().grade_segments(answer, rubric, segments, question=question)
+
     prompt = f"""
     You are an expert teacher grading a student's answer.
 
@@ -201,18 +431,76 @@ def ai_grade_segments(answer, rubric, segments, endpoint='groq'):
     Extracted Segments:
     {segments}
     """
-    response = use_groq(prompt)
+    prompt = _select_prompt('scoring', prompt, _compact_scoring_prompt(answer, rubric, segments))
+    response = _call_llm(prompt, 'scoring', 'stub' if endpoint == 'stub' else 'groq', rubric=rubric, segments=segments)
     return parse_tentative_scores(response.content)
 
 
+def _compact_scoring_prompt(answer, rubric, segments):
+    """
+    Scoring prompt with rubric and segments merged into one list.
+
+    Segments are matched to criteria by exact text. When some criterion has
+    no segment (e.g. the rubric was edited after segmentation, or the LLM
+    reworded a criterion), the segments that matched no criterion and the
+    full answer are appended so the answer is not scored as unaddressed.
+    """
+    template = """
+    You are an expert teacher grading a student's answer.
+
+    For each rubric point below, assign a tentative score out of its marks
+    based on the extracted answer segment.
+
+    Return in this format strictly:
+    <start>
+    Rubric: <rubric point>
+    Tentative_Score: <score>
+    ####
+    ...
+    <end>
+
+    Rubric points and extracted segments:
+    {criteria}
+    """
+    prompt = compact_text(template).format(criteria=compact_segments(rubric, segments))
+    segments = segments or {}
+    if any(criterion not in segments for criterion in rubric):
+        unmatched = [(c, part) for c, part in segments.items() if c not in rubric]
+        if unmatched:
+            prompt += "\n\nOther extracted segments (criterion names may differ from the rubric):\n"
+            prompt += "\n".join(f"- {c}: {part}" for c, part in unmatched)
+        prompt += f"\n\nStudent's answer (grade criteria without a segment from this):\n{answer.strip()}"
+    return prompt
+
+
+@traced()
+def process_answer(answer, rubric, endpoint='groq', scoring_endpoint='groq', question=None):
+    """
+    Runs segmentation followed by tentative scoring for one answer.
+
+    Args:
+        answer (str): The student's subjective answer.
+        rubric (dict): Parsed rubric {criterion: marks}.
+        endpoint (str): Segmentation endpoint ('groq', 'stub', 'deberta', 'embedding_model' or 'embedding_rerank').
+        scoring_endpoint (str): Scoring endpoint ('groq', 'stub' or 'local').
+        question (str): Question text, used by the 'local' scoring endpoint.
+
+    Returns:
+        tuple: (segments OrderedDict, tentative scores dict)
+    """
+    raw_segments = break_answer_into_points(answer, rubric, endpoint=endpoint)
+    segments = parse_answer_segments(raw_segments)
+    scores = ai_grade_segments(answer, rubric, segments, endpoint=scoring_endpoint, question=question)
+    return segments, scores
+
+
 
 
 def suggest_rubric_modification(answer, rubric, endpoint='groq'):  #, segments
     import textwrap
-    from Generative_models import use_groq
 #   The AI previously extracted the following mapping of answer parts to rubric points:
 #     {segments}
-    prompt = f"""
+    template = """
     You are an expert educational evaluator reviewing a grading rubric and a student's answer.
 
     The current rubric is:
@@ -230,8 +518,14 @@ def suggest_rubric_modification(answer, rubric, endpoint='groq'):  #, segments
     [Suggestion or 'No modification needed.']
     <end>
     """
-
-    response = use_groq(textwrap.dedent(prompt).strip())
+    prompt = template.format(rubric=rubric, answer=answer)
+
+    prompt = _select_prompt(
+        'rubric_modification',
+        textwrap.dedent(prompt).strip(),
+        compact_text(template).format(rubric=compact_rubric(rubric), answer=answer.strip()),
+    )
+    response = _call_llm(prompt, 'rubric_modification', endpoint)
     return response.content
 
     # - Check if the answer contains significant correct concepts or reasoning steps that are not covered by any rubric point.
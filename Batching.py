@@ -0,0 +1,135 @@
+import os
+import random
+import sys
+import time
+
+# Token budget per forward pass: a batch is closed when
+# (longest sequence in the batch) x (batch size) would exceed it.
+QA_TOKEN_BUDGET = int(os.getenv("QA_TOKEN_BUDGET", "8192"))
+EMBEDDING_TOKEN_BUDGET = int(os.getenv("EMBEDDING_TOKEN_BUDGET", "16384"))
+
+
+def token_budget_batches(lengths, max_tokens, max_batch_size=64):
+    """
+    Groups inputs into batches of similar length.
+
+    Indices are sorted by length and packed greedily so that each batch's
+    padded size (longest length x batch size) stays within `max_tokens`.
+    An input longer than the budget gets a batch of its own.
+
+    Args:
+        lengths (list): Token length of each input.
+        max_tokens (int): Padded-token budget per batch.
+        max_batch_size (int): Hard cap on inputs per batch.
+
+    Returns:
+        list: Lists of input indices, one per batch.
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    batches, batch, batch_max = [], [], 0
+    for i in order:
+        longest = max(batch_max, lengths[i])
+        if batch and (longest * (len(batch) + 1) > max_tokens or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch, longest = [], lengths[i]
+        batch.append(i)
+        batch_max = longest
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def fixed_size_batches(n, batch_size):
+    """Arrival-order batches of `batch_size` (the un-bucketed baseline)."""
+    return [list(range(i, min(i + batch_size, n))) for i in range(0, n, batch_size)]
+
+
+def run_batched(inputs, batches, fn):
+    """
+    Calls `fn(list_of_inputs)` once per batch of indices and returns the
+    results in the original input order.
+    """
+    results = [None] * len(inputs)
+    for batch in batches:
+        for i, result in zip(batch, fn([inputs[i] for i in batch])):
+            results[i] = result
+    return results
+
+
+def padding_stats(lengths, batches):
+    """Real vs padded token counts for a batching plan."""
+    real = sum(lengths)
+    padded = sum(max(lengths[i] for i in batch) * len(batch) for batch in batches if batch)
+    return {
+        "batches": len(batches),
+        "real_tokens": real,
+        "padded_tokens": padded,
+        "padding_waste": 1 - real / padded if padded else 0.0,
+    }
+
+
+def _mixed_length_answers(n, seed=0):
+    """Synthetic answer set from one line up to several pages, built from the demo answer."""
+    from Automations import demo_answer
+    sentences = [s.strip() for s in demo_answer.strip().split("\n") if s.strip()]
+    rng = random.Random(seed)
+    answers = []
+    for _ in range(n):
+        n_sent = rng.choice([1, 2, 3, 5, 10, 20, 40])
+        answers.append(" ".join(rng.choice(sentences) for _ in range(n_sent)))
+    return answers
+
+
+def benchmark(n_answers=64, batch_size=8, run_models=False):
+    """
+    Compares arrival-order fixed-size batching with token-budget bucketing on a
+    mixed-length answer set: padding waste always, and DeBERTa / MPNet
+    throughput when `run_models` is set.
+    """
+    answers = _mixed_length_answers(n_answers)
+    rubric = {
+        "Defines generative AI": 3,
+        "Describes key technologies": 3,
+        "Discusses applications and ethical concerns": 4,
+    }
+
+    try:
+        # only the tokenizer is needed to count tokens; the QA model is loaded below if run_models
+        from transformers import AutoTokenizer
+        from Checkpoints import OFFLINE, is_local_checkpoint
+        from Generative_models import DEBERTA_MODEL_NAME
+        tokenizer = AutoTokenizer.from_pretrained(
+            DEBERTA_MODEL_NAME, local_files_only=OFFLINE or is_local_checkpoint(DEBERTA_MODEL_NAME)
+        )
+        count = lambda text: len(tokenizer(text)["input_ids"])
+    except Exception:
+        count = lambda text: int(len(text.split()) * 1.3)  # rough word-to-token ratio
+
+    # QA sequences are truncated to the pipeline's 384-token window
+    qa_lengths = [min(count(q) + count(a), 384) for a in answers for q in rubric]
+    print(f"{len(qa_lengths)} QA pairs, lengths {min(qa_lengths)}-{max(qa_lengths)} tokens")
+    for label, plan in [
+        (f"fixed batches of {batch_size}", fixed_size_batches(len(qa_lengths), batch_size)),
+        (f"token budget {QA_TOKEN_BUDGET}", token_budget_batches(qa_lengths, QA_TOKEN_BUDGET)),
+    ]:
+        s = padding_stats(qa_lengths, plan)
+        print(f"  {label:<28} {s['batches']:>4} batches, {s['padded_tokens']:>7} padded tokens, "
+              f"{100 * s['padding_waste']:.0f}% padding")
+
+    if not run_models:
+        return
+    from Generative_models import use_deberta_batch, extract_relevant_passages_batch
+    items = [(a, rubric) for a in answers]
+    for name, fn in [("deberta", use_deberta_batch), ("embedding_model", extract_relevant_passages_batch)]:
+        fn(items[:2])  # warm up
+        timings = {}
+        for label, kwargs in [("fixed", {"max_tokens": None}), ("bucketed", {})]:
+            start = time.perf_counter()
+            fn(items, **kwargs)
+            timings[label] = time.perf_counter() - start
+        print(f"  {name:<16} fixed {timings['fixed']:.1f}s, bucketed {timings['bucketed']:.1f}s "
+              f"({timings['fixed'] / timings['bucketed']:.2f}x)")
+
+
+if __name__ == "__main__":
+    benchmark(run_models="--models" in sys.argv)
@@ -0,0 +1,216 @@
+import json
+import mmap
+import os
+import struct
+import warnings
+from contextlib import contextmanager
+
+import torch
+
+# Set GRADER_OFFLINE=1 on air-gapped graders: nothing is fetched from the hub
+# and missing checkpoints are reported at startup instead of on first use.
+OFFLINE = os.getenv("GRADER_OFFLINE", "0") == "1"
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+# Open mappings stay referenced for the life of the process; the tensors point into them.
+_MAPPINGS = []
+
+
+def is_local_checkpoint(name_or_path):
+    return os.path.isdir(name_or_path)
+
+
+def _safetensors_files(directory):
+    index_path = os.path.join(directory, "model.safetensors.index.json")
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            shards = sorted(set(json.load(f)["weight_map"].values()))
+        return [os.path.join(directory, shard) for shard in shards]
+    single = os.path.join(directory, "model.safetensors")
+    return [single] if os.path.exists(single) else []
+
+
+def load_safetensors_mmap(path):
+    """
+    Returns {name: tensor} for a .safetensors file without copying the weights.
+
+    Tensors are read-only views into a shared, read-only mmap of the file, so
+    every worker process loading the same checkpoint shares the same page
+    cache pages instead of holding a private copy.
+    """
+    with open(path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _MAPPINGS.append(mapping)
+
+    header_len = struct.unpack("<Q", mapping[:8])[0]
+    header = json.loads(mapping[8:8 + header_len])
+    header.pop("__metadata__", None)
+    base = 8 + header_len
+
+    state = {}
+    with warnings.catch_warnings():
+        # torch warns that the buffer is not writable; inference never writes weights
+        warnings.simplefilter("ignore", UserWarning)
+        for name, info in header.items():
+            dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+            start, end = info["data_offsets"]
+            itemsize = torch.empty((), dtype=dtype).element_size()
+            count = (end - start) // itemsize
+            if count == 0:
+                state[name] = torch.empty(info["shape"], dtype=dtype)
+                continue
+            tensor = torch.frombuffer(mapping, dtype=dtype, count=count, offset=base + start)
+            state[name] = tensor.reshape(info["shape"])
+    return state
+
+
+def share_weights(module, directory):
+    """
+    Replace a module's parameters with mmap-backed tensors from the
+    safetensors files in `directory`. Returns False (leaving the module as
+    loaded) when there are no safetensors files or the keys don't match.
+    """
+    files = _safetensors_files(directory)
+    if not files:
+        return False
+    state = {}
+    for path in files:
+        state.update(load_safetensors_mmap(path))
+    expected = set(module.state_dict().keys())
+    # Tied weights are stored once and position_ids are rebuilt by the model;
+    # anything else missing means the file doesn't belong to this module.
+    tied = set(getattr(module, "_tied_weights_keys", None) or [])
+    missing = [k for k in expected - state.keys() if k not in tied and not k.endswith("position_ids")]
+    if missing:
+        print(f"⚠️ Warning: {directory} does not match the model ({len(missing)} missing weights); keeping the regular copy")
+        return False
+    module.load_state_dict({k: v for k, v in state.items() if k in expected}, strict=False, assign=True)
+    if hasattr(module, "tie_weights"):
+        module.tie_weights()
+    return True
+
+
+def _no_init_weights():
+    try:
+        from transformers.modeling_utils import no_init_weights
+    except ImportError:
+        from contextlib import nullcontext as no_init_weights
+    return no_init_weights()
+
+
+@contextmanager
+def _built_from_config(auto_class, directory):
+    """
+    Inside the block, `auto_class.from_pretrained(directory, ...)` builds the
+    model from its config with uninitialized weights instead of reading them.
+    Callers hold the model-cache lock, so no other load sees the patch.
+    """
+    from transformers import AutoConfig
+
+    original = auto_class.__dict__.get("from_pretrained")
+    load = auto_class.from_pretrained
+
+    def from_pretrained(name_or_path, *args, config=None, **kwargs):
+        if os.path.abspath(str(name_or_path)) != os.path.abspath(directory):
+            return load(name_or_path, *args, config=config, **kwargs)
+        if config is None:
+            config = AutoConfig.from_pretrained(directory, local_files_only=True)
+        options = {k: kwargs[k] for k in ("trust_remote_code", "torch_dtype") if kwargs.get(k) not in (None, "auto")}
+        with _no_init_weights():
+            return auto_class.from_config(config, **options)
+
+    auto_class.from_pretrained = from_pretrained
+    try:
+        yield
+    finally:
+        if original is None:
+            del auto_class.from_pretrained
+        else:
+            auto_class.from_pretrained = original
+
+
+def load_shared(build, inner_model, directory, auto_class):
+    """
+    Build a model wrapper (SentenceTransformer, CrossEncoder) for a local
+    checkpoint so that its transformer uses mmap-backed weights, without a
+    private copy ever being loaded.
+
+    `build()` constructs the wrapper; `inner_model(wrapper)` returns the
+    transformer it loaded with `auto_class.from_pretrained`. That model is
+    built from its config under no_init_weights, as in load_qa_model, and
+    then given the shared weights. If they can't be shared, the wrapper is
+    built again the regular way.
+    """
+    if not is_local_checkpoint(directory) or not _safetensors_files(directory):
+        return build()
+    with _built_from_config(auto_class, directory):
+        wrapper = build()
+    if share_weights(inner_model(wrapper), directory):
+        return wrapper
+    return build()
+
+
+def load_qa_model(name_or_path):
+    """
+    Load a question-answering model and tokenizer from a hub name or a local
+    checkpoint directory (e.g. a fine-tuned DeBERTa/BigBird from the
+    Fine-tuning Experiments notebooks, saved with save_pretrained).
+    Local safetensors weights are memory-mapped and shared between processes.
+    """
+    from transformers import AutoConfig, AutoModelForQuestionAnswering, AutoTokenizer
+
+    local = is_local_checkpoint(name_or_path)
+    local_only = OFFLINE or local
+    tokenizer = AutoTokenizer.from_pretrained(name_or_path, local_files_only=local_only)
+
+    if local and _safetensors_files(name_or_path):
+        config = AutoConfig.from_pretrained(name_or_path, local_files_only=True)
+        with _no_init_weights():
+            model = AutoModelForQuestionAnswering.from_config(config)
+        if share_weights(model, name_or_path):
+            return model.eval(), tokenizer
+
+    model = AutoModelForQuestionAnswering.from_pretrained(name_or_path, local_files_only=local_only)
+    return model.eval(), tokenizer
+
+
+def _hub_cached(repo_id):
+    try:
+        from huggingface_hub import try_to_load_from_cache
+    except ImportError:
+        return False
+    return isinstance(try_to_load_from_cache(repo_id, "config.json"), str)
+
+
+def verify_checkpoints(checkpoints):
+    """
+    Checks that each checkpoint can be loaded without network access.
+
+    Args:
+        checkpoints (dict): {label: hub name or local directory}
+
+    Returns:
+        dict: {label: problem} for every checkpoint that is not available
+        (empty when everything can be loaded offline).
+    """
+    problems = {}
+    for label, name_or_path in checkpoints.items():
+        if is_local_checkpoint(name_or_path):
+            if not os.path.exists(os.path.join(name_or_path, "config.json")) and \
+                    not os.path.exists(os.path.join(name_or_path, "modules.json")):
+                problems[label] = f"{name_or_path} has no config.json / modules.json"
+            elif not _safetensors_files(name_or_path) and \
+                    not os.path.exists(os.path.join(name_or_path, "pytorch_model.bin")):
+                problems[label] = f"{name_or_path} has no model weights"
+        elif os.path.exists(name_or_path):
+            problems[label] = f"{name_or_path} is not a directory"
+        elif "/" in name_or_path and not _hub_cached(name_or_path):
+            problems[label] = f"{name_or_path} is not in the local Hugging Face cache"
+        elif "/" not in name_or_path and not _hub_cached(f"sentence-transformers/{name_or_path}"):
+            problems[label] = f"sentence-transformers/{name_or_path} is not in the local Hugging Face cache"
+    return problems
@@ -0,0 +1,325 @@
+import functools
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+from Automations import generate_rubric_2, break_answer_into_points, ai_grade_segments
+from Generative_models import use_deberta_batch, extract_relevant_passages_batch
+from Parsers import parse_answer_segments, parse_rubric
+from Token_budget import ledger
+
+# Maximum concurrent calls per endpoint. Local models get one slot each (a
+# batch already uses every core); Groq calls are I/O bound.
+DEFAULT_ENDPOINT_LIMITS = {'groq': 8, 'stub': 8, 'deberta': 1, 'embedding_model': 1, 'embedding_rerank': 1, 'local': 16}
+
+# Segmentation endpoints that accept many (answer, rubric) pairs per call
+LOCAL_BATCH_FUNCTIONS = {
+    'deberta': use_deberta_batch,
+    'embedding_model': extract_relevant_passages_batch,
+    'embedding_rerank': functools.partial(extract_relevant_passages_batch, rerank=True),
+}
+
+
+@dataclass
+class ExamQuestion:
+    question_id: str
+    question: str
+    marks: int
+    rubric: Optional[dict] = None  # generated with generate_rubric_2 when missing
+    endpoint: str = 'groq'  # segmentation endpoint
+    scoring_endpoint: str = 'groq'  # or 'local' (Score_calibration.py) or 'stub' (Stub_llm.py)
+    demo_answers: str = ""
+
+
+@dataclass
+class UnitResult:
+    student_id: str
+    question_id: str
+    segments: OrderedDict = field(default_factory=OrderedDict)
+    scores: dict = field(default_factory=dict)
+    error: Optional[str] = None
+    segment_s: Optional[float] = None  # wall time (a local batch's time is split evenly)
+    score_s: Optional[float] = None
+
+
+@dataclass
+class ExamResult:
+    questions: dict
+    units: dict  # (student_id, question_id) -> UnitResult
+    elapsed_s: float
+
+    def totals(self):
+        """Per-student total of tentative scores across all questions."""
+        totals = defaultdict(float)
+        for (student_id, _), unit in self.units.items():
+            totals[student_id] += sum(unit.scores.values())
+        return dict(totals)
+
+    def breakdown(self):
+        """{student_id: {question_id: question score}}"""
+        table = defaultdict(dict)
+        for (student_id, question_id), unit in self.units.items():
+            table[student_id][question_id] = sum(unit.scores.values())
+        return dict(table)
+
+    def max_total(self):
+        return sum(sum(q.rubric.values()) for q in self.questions.values() if q.rubric)
+
+    def errors(self):
+        return [u for u in self.units.values() if u.error]
+
+    def throughput(self):
+        return len(self.units) / self.elapsed_s if self.elapsed_s else 0.0
+
+
+class ExamGrader:
+    """
+    Grades every (student, question) unit of an exam on one shared thread pool.
+
+    Units are grouped by question so each rubric's answers go through the
+    local segmentation models in batches of `local_batch_size`; Groq calls
+    run per unit. Every model call holds a slot of its endpoint's semaphore,
+    so adding questions adds work to the same pool instead of new pools.
+    A unit's scoring is scheduled as soon as its segmentation finishes.
+
+    With an `index`, exact duplicates of an answer to the same question are
+    graded once and share the result, and each answer is looked up in the
+    index by the worker that would otherwise segment it.
+    """
+
+    def __init__(self, max_workers=16, endpoint_limits=None, local_batch_size=16, index=None):
+        limits = dict(DEFAULT_ENDPOINT_LIMITS)
+        limits.update(endpoint_limits or {})
+        self._limits = defaultdict(lambda: threading.Semaphore(4))
+        for endpoint, limit in limits.items():
+            self._limits[endpoint] = threading.Semaphore(limit)
+        self.max_workers = max_workers
+        self.local_batch_size = local_batch_size
+        self.index = index  # optional Answer_index.AnswerIndex for duplicate reuse
+        self._executor = None
+        self._lock = threading.Lock()
+        self._outstanding = 0
+        self._finished = threading.Event()
+        self._units = {}
+        self._duplicates = {}  # id(graded unit) -> units with the same answer to the same question
+
+    # -- task bookkeeping -------------------------------------------------
+    def _submit(self, fn, *args):
+        with self._lock:
+            self._outstanding += 1
+        ledger.submit(self._executor, self._run, fn, args, default='exam')
+
+    def _run(self, fn, args):
+        try:
+            fn(*args)
+        finally:
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            self._outstanding -= 1
+            if self._outstanding == 0:
+                self._finished.set()
+
+    def _fail(self, units, error):
+        for unit in units:
+            unit.error = f"{type(error).__name__}: {error}"
+            for duplicate in self._duplicates.get(id(unit), ()):
+                duplicate.error = unit.error
+
+    def _share(self, unit):
+        """Copy a graded unit's result to its duplicates."""
+        for duplicate in self._duplicates.get(id(unit), ()):
+            duplicate.segments, duplicate.scores = OrderedDict(unit.segments), dict(unit.scores)
+
+    def _reuse(self, question, unit, answer):
+        """
+        Look `answer` up in the index. Returns (reused, embedding); the
+        embedding is kept so `_score` can index the answer without re-encoding it.
+        """
+        if self.index is None:
+            return False, None
+        match, embedding = self.index.lookup(answer, question.rubric)
+        if match is None:
+            return False, embedding
+        unit.segments, unit.scores = match.segments, match.scores
+        self._share(unit)
+        return True, None
+
+    # -- tasks ------------------------------------------------------------
+    def _generate_rubric(self, question):
+        # Offline exams (stub segmentation) also get their rubric from the stub
+        endpoint = 'stub' if question.endpoint == 'stub' else 'groq'
+        with self._limits[endpoint]:
+            question.rubric = parse_rubric(
+                generate_rubric_2(question.question, question.marks, question.demo_answers, endpoint=endpoint)
+            )
+        if not question.rubric:
+            raise ValueError(f"Could not generate a rubric for question {question.question_id}")
+
+    def _segment_local(self, question, units, answers):
+        pending = []
+        for unit, answer in zip(units, answers):
+            try:
+                reused, embedding = self._reuse(question, unit, answer)
+            except Exception as e:
+                self._fail([unit], e)
+                continue
+            if not reused:
+                pending.append((unit, answer, embedding))
+        if not pending:
+            return
+        units, answers, embeddings = zip(*pending)
+        try:
+            with self._limits[question.endpoint]:
+                start = time.perf_counter()
+                raw = LOCAL_BATCH_FUNCTIONS[question.endpoint]([(answer, question.rubric) for answer in answers])
+                elapsed = (time.perf_counter() - start) / len(units)
+        except Exception as e:
+            self._fail(units, e)
+            return
+        for unit, answer, embedding, raw_segments in zip(units, answers, embeddings, raw):
+            unit.segments = parse_answer_segments(raw_segments)
+            unit.segment_s = elapsed
+            self._submit(self._score, question, unit, answer, embedding)
+
+    def _segment_remote(self, question, unit, answer):
+        try:
+            reused, embedding = self._reuse(question, unit, answer)
+            if reused:
+                return
+            with self._limits[question.endpoint]:
+                start = time.perf_counter()
+                raw_segments = break_answer_into_points(answer, question.rubric, endpoint=question.endpoint)
+                unit.segment_s = time.perf_counter() - start
+        except Exception as e:
+            self._fail([unit], e)
+            return
+        unit.segments = parse_answer_segments(raw_segments)
+        self._submit(self._score, question, unit, answer, embedding)
+
+    def _score(self, question, unit, answer, embedding=None):
+        try:
+            with self._limits[question.scoring_endpoint]:
+                start = time.perf_counter()
+                unit.scores = ai_grade_segments(
+                    answer, question.rubric, unit.segments, endpoint=question.scoring_endpoint, question=question.question
+                )
+                unit.score_s = time.perf_counter() - start
+        except Exception as e:
+            self._fail([unit], e)
+            return
+        self._share(unit)
+        if self.index is not None:
+            self.index.add(answer, question.rubric, unit.segments, unit.scores, embedding=embedding)
+
+    # -- entry point --------------------------------------------------------
+    def grade(self, questions, scripts):
+        """
+        Args:
+            questions (list): ExamQuestion objects.
+            scripts (dict): {student_id: {question_id: answer text}}.
+
+        Returns:
+            ExamResult
+        """
+        start = time.perf_counter()
+        questions = OrderedDict((q.question_id, q) for q in questions)
+        self._units = {}
+        self._duplicates = {}
+        self._outstanding = 0
+        self._finished.clear()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            self._executor = executor
+
+            # Rubrics first (concurrently), since every unit depends on one.
+            # A question whose rubric fails is reported on its units; the rest are still graded.
+            missing = [q for q in questions.values() if not q.rubric]
+            futures = [ledger.submit(executor, self._generate_rubric, q, default='exam') for q in missing]
+            rubric_errors = {}
+            for question, future in zip(missing, futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    rubric_errors[question.question_id] = f"rubric generation failed: {type(e).__name__}: {e}"
+
+            # Group units by question so each rubric's answers batch together
+            by_question = defaultdict(list)
+            graded = {}  # (question_id, answer key) -> unit graded for that answer
+            for student_id, answers in scripts.items():
+                for question_id, answer in answers.items():
+                    if question_id not in questions:
+                        raise ValueError(f"Script of {student_id} answers unknown question '{question_id}'")
+                    unit = UnitResult(student_id, question_id)
+                    self._units[(student_id, question_id)] = unit
+                    if question_id in rubric_errors:
+                        unit.error = rubric_errors[question_id]
+                        continue
+                    if not answer or not answer.strip():
+                        continue  # unanswered question scores zero
+                    if self.index is not None:
+                        key = (question_id, self.index.answer_key(answer))
+                        if key in graded:
+                            self._duplicates.setdefault(id(graded[key]), []).append(unit)
+                            continue
+                        graded[key] = unit
+                    by_question[question_id].append((unit, answer))
+
+            # Hold one count while submitting so early finishers can't signal completion
+            with self._lock:
+                self._outstanding += 1
+            for question_id, pending in by_question.items():
+                question = questions[question_id]
+                if question.endpoint in LOCAL_BATCH_FUNCTIONS:
+                    for i in range(0, len(pending), self.local_batch_size):
+                        chunk = pending[i:i + self.local_batch_size]
+                        self._submit(self._segment_local, question, [u for u, _ in chunk], [a for _, a in chunk])
+                else:
+                    for unit, answer in pending:
+                        self._submit(self._segment_remote, question, unit, answer)
+
+            self._release()
+            self._finished.wait()
+            self._executor = None
+
+        return ExamResult(dict(questions), dict(self._units), time.perf_counter() - start)
+
+
+def grade_exam(questions, scripts, **kwargs):
+    """Convenience wrapper around ExamGrader(**kwargs).grade(questions, scripts)."""
+    return ExamGrader(**kwargs).grade(questions, scripts)
+
+
+def load_exam(path):
+    """
+    Load an exam from JSON:
+        {"questions": [{"question_id", "question", "marks", "rubric"?, "endpoint"?}],
+         "scripts": {student_id: {question_id: answer}}}
+    """
+    with open(path) as f:
+        data = json.load(f)
+    questions = [ExamQuestion(**q) for q in data["questions"]]
+    return questions, data["scripts"]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 4) or (len(sys.argv) == 4 and sys.argv[2] != "--export"):
+        print("usage: python Exam.py exam.json [--export results.parquet|.arrow|.csv]")
+        sys.exit(1)
+    questions, scripts = load_exam(sys.argv[1])
+    result = grade_exam(questions, scripts)
+    print(f"Graded {len(result.units)} answers in {result.elapsed_s:.1f}s ({result.throughput():.2f} answers/s)")
+    for unit in result.errors():
+        print(f"⚠️ {unit.student_id} / {unit.question_id}: {unit.error}")
+    for student_id, total in sorted(result.totals().items()):
+        print(f"{student_id}: {total} / {result.max_total()}")
+    if len(sys.argv) == 4:
+        from Exporters import export_results, rows_from_exam
+        n = export_results(rows_from_exam(result), sys.argv[3])
+        print(f"Exported {n} rows to {sys.argv[3]}")
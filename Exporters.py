@@ -0,0 +1,209 @@
+import csv
+import os
+import sys
+from itertools import islice
+
+# One row per (student, question, criterion). The column set is fixed so
+# every chunk of a streamed export shares the same schema.
+COLUMNS = [
+    ("student_id", "string"),
+    ("question_id", "string"),
+    ("question", "string"),
+    ("criterion", "string"),
+    ("max_marks", "float"),
+    ("segment", "string"),
+    ("ai_score", "float"),
+    ("final_score", "float"),
+    ("segmentation_endpoint", "string"),
+    ("scoring_endpoint", "string"),
+    ("segment_s", "float"),
+    ("score_s", "float"),
+]
+COLUMN_NAMES = [name for name, _ in COLUMNS]
+
+EXPORT_CHUNK_ROWS = 10000
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet/Arrow export needs pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+def _schema(pa):
+    types = {"string": pa.string(), "float": pa.float64()}
+    return pa.schema([(name, types[kind]) for name, kind in COLUMNS])
+
+
+_EXTENSIONS = {".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow", ".csv": "csv"}
+
+
+def _format(path, fmt):
+    if fmt:
+        return fmt.lower()
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in _EXTENSIONS:
+        raise ValueError(f"Cannot infer export format from '{path}'; pass fmt='parquet', 'arrow' or 'csv'")
+    return _EXTENSIONS[ext]
+
+
+def _to_float(value):
+    if value is None or value == "":
+        return None
+    return float(value)
+
+
+def _normalize(row):
+    out = {}
+    for name, kind in COLUMNS:
+        value = row.get(name)
+        # CSV has no null, so empty strings read back as None in every format
+        out[name] = _to_float(value) if kind == "float" else (None if value in (None, "") else str(value))
+    return out
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield [_normalize(r) for r in chunk]
+
+
+def export_results(rows, path, fmt=None, chunk_size=EXPORT_CHUNK_ROWS):
+    """
+    Streams result rows (dicts keyed by COLUMN_NAMES) to Parquet, Arrow IPC or CSV.
+
+    Rows may come from any iterable, including a generator; only `chunk_size`
+    rows are held in memory at a time, so exports of any size run in
+    constant memory. Parquet files get one row group per chunk.
+
+    Returns:
+        int: Number of rows written.
+    """
+    fmt = _format(path, fmt)
+    written = 0
+    if fmt == "csv":
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMN_NAMES)
+            writer.writeheader()
+            for chunk in _chunks(rows, chunk_size):
+                writer.writerows(chunk)
+                written += len(chunk)
+        return written
+
+    pa = _pyarrow()
+    schema = _schema(pa)
+    if fmt == "parquet":
+        writer = pa.parquet.ParquetWriter(path, schema, compression="zstd")
+        write = writer.write_table
+    elif fmt == "arrow":
+        sink = pa.OSFile(path, "wb")
+        writer = pa.ipc.new_file(sink, schema)
+        write = writer.write_table
+    else:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    try:
+        for chunk in _chunks(rows, chunk_size):
+            write(pa.Table.from_pylist(chunk, schema=schema))
+            written += len(chunk)
+    finally:
+        writer.close()
+        if fmt == "arrow":
+            sink.close()
+    return written
+
+
+def load_results(path, fmt=None, columns=None, batch_size=EXPORT_CHUNK_ROWS):
+    """
+    Streams rows back from a file written by export_results, as dicts.
+    Only `batch_size` rows are decoded at a time.
+    """
+    fmt = _format(path, fmt)
+    if fmt == "csv":
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                row = _normalize(row)
+                yield {k: row[k] for k in columns} if columns else row
+        return
+
+    pa = _pyarrow()
+    if fmt == "parquet":
+        batches = pa.parquet.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns)
+        for batch in batches:
+            yield from batch.to_pylist()
+    elif fmt == "arrow":
+        with pa.memory_map(path, "r") as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                if columns:
+                    batch = batch.select(columns)
+                yield from batch.to_pylist()
+    else:
+        raise ValueError(f"Unsupported export format: {fmt}")
+
+
+def rows_from_exam(result):
+    """Rows for an Exam.ExamResult (final_score starts as the AI score)."""
+    for (student_id, question_id), unit in result.units.items():
+        question = result.questions[question_id]
+        for criterion, max_marks in (question.rubric or {}).items():
+            ai_score = unit.scores.get(criterion)
+            yield {
+                "student_id": student_id,
+                "question_id": question_id,
+                "question": question.question,
+                "criterion": criterion,
+                "max_marks": max_marks,
+                "segment": unit.segments.get(criterion, "Not addressed"),
+                "ai_score": ai_score,
+                "final_score": ai_score,
+                "segmentation_endpoint": question.endpoint,
+                "scoring_endpoint": question.scoring_endpoint,
+                "segment_s": unit.segment_s,
+                "score_s": unit.score_s,
+            }
+
+
+def rows_from_saved_scores(records):
+    """Rows for instructor scores saved by Score_calibration.record_final_scores."""
+    for r in records:
+        yield {
+            "student_id": r.get("student_id"),
+            "question_id": r.get("question_key"),
+            "question": r.get("question"),
+            "criterion": r.get("criterion"),
+            "max_marks": r.get("max_marks"),
+            "segment": r.get("segment"),
+            "ai_score": r.get("ai_score"),
+            "final_score": r.get("final_score"),
+            "segmentation_endpoint": r.get("endpoint"),
+            "scoring_endpoint": r.get("scoring_endpoint"),
+        }
+
+
+def final_scores_index(path, fmt=None):
+    """
+    {(student_id, question_id, criterion): final_score} from an export, for
+    incremental regrades that keep instructor decisions already made.
+    """
+    return {
+        (r["student_id"], r["question_id"], r["criterion"]): r["final_score"]
+        for r in load_results(path, fmt, columns=["student_id", "question_id", "criterion", "final_score"])
+    }
+
+
+if __name__ == "__main__":
+    # python Exporters.py instructor_scores.jsonl results.parquet
+    if len(sys.argv) != 3:
+        print("usage: python Exporters.py <saved scores .jsonl> <output .parquet|.arrow|.csv>")
+        sys.exit(1)
+    from Score_calibration import iter_records
+    n = export_results(rows_from_saved_scores(iter_records(sys.argv[1])), sys.argv[2])
+    print(f"Exported {n} rows to {sys.argv[2]}")
@@ -2,16 +2,41 @@ from langchain_groq import ChatGroq
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
 import os
-from transformers import AutoTokenizer, AutoModelForQuestionAnswering, pipeline
-from sentence_transformers import SentenceTransformer, util
+from transformers import AutoModel, AutoModelForSequenceClassification, pipeline
+from sentence_transformers import SentenceTransformer, CrossEncoder, util
 import nltk
 import torch
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from Token_budget import ledger, response_token_usage
+from Tracing import span, traced, annotate
+from Checkpoints import OFFLINE, is_local_checkpoint, load_qa_model, load_shared, verify_checkpoints
+from Batching import QA_TOKEN_BUDGET, EMBEDDING_TOKEN_BUDGET, token_budget_batches, fixed_size_batches, run_batched
+from Stub_llm import STUB_MODEL_NAME, get_stub
 
+# Load .env file
+load_dotenv()
+
+# Each local model can point at a hub name or a local checkpoint directory
+# (e.g. the fine-tuned models from "Fine-tuning Experiments").
 GROQ_MODEL_NAME="openai/gpt-oss-120b" #"llama-3.3-70b-versatile"
+DEBERTA_MODEL_NAME=os.getenv("DEBERTA_CHECKPOINT", "deepset/deberta-v3-large-squad2")#"deepset/roberta-large-squad2"
+EMBEDDING_MODEL_NAME=os.getenv("EMBEDDING_CHECKPOINT", 'all-mpnet-base-v2')
+RERANK_MODEL_NAME=os.getenv("RERANK_CHECKPOINT", 'cross-encoder/ms-marco-MiniLM-L-6-v2')
 
+# Rate-limited (429) and server-error LLM calls are retried with exponential
+# backoff, honouring the provider's retry-after when it sends one.
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_S = float(os.getenv("LLM_RETRY_BASE_S", "0.5"))
+
+# Local models are loaded once per process and shared by every caller
+# (Streamlit reruns, prefetch workers). The lock keeps two threads from
+# loading the same weights concurrently.
+_MODEL_CACHE = {}
+_MODEL_CACHE_LOCK = threading.Lock()
 
-# Load .env file
-load_dotenv()
 
 def use_gemini():
     api_key = os.getenv("GOOGLE_API_KEY")
@@ -23,53 +48,243 @@ def use_gemini():
     return response
 
 
-def use_groq(prompt,model_name=GROQ_MODEL_NAME):
+def _is_retryable(error):
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+def _retry_after(error):
+    """
+    Seconds the provider asked us to wait, or None. Read from the error's
+    `retry_after` (stub) or the HTTP response's retry-after-ms / retry-after
+    header (Groq/httpx errors; seconds or an HTTP date).
+    """
+    value = getattr(error, "retry_after", None)
+    if value is not None:
+        return float(value)
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    lookup = {str(k).lower(): v for k, v in headers.items()}
+    try:
+        if lookup.get("retry-after-ms") is not None:
+            return float(lookup["retry-after-ms"]) / 1000
+        value = lookup.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _invoke_with_retries(invoke, stage):
+    """Call `invoke()` and retry rate-limit/server errors. Returns (response, retries)."""
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            return invoke(), attempt
+        except Exception as e:
+            if attempt == LLM_MAX_RETRIES or not _is_retryable(e):
+                raise
+            ledger.record_retry(stage)
+            delay = _retry_after(e)
+            if delay is None:
+                delay = LLM_RETRY_BASE_S * 2 ** attempt * random.uniform(0.5, 1.0)
+            time.sleep(delay)
+
+
+def use_groq(prompt,model_name=GROQ_MODEL_NAME,stage='unspecified'):
     api_key = os.getenv("GROQ_API_KEY")
     if not api_key:
         raise ValueError("Missing GROQ_API_KEY in .env file")
 
-    model = ChatGroq(model=model_name, groq_api_key=api_key)
+    # Retries are done by _invoke_with_retries so they show up in the ledger
+    model = ChatGroq(model=model_name, groq_api_key=api_key, max_retries=0)
     
-    response = model.invoke(prompt)
+    with span('use_groq', model=model_name, stage=stage) as s:
+        start = time.perf_counter()
+        response, retries = _invoke_with_retries(lambda: model.invoke(prompt), stage)
+        prompt_tokens, completion_tokens = response_token_usage(response, prompt)
+        ledger.record(stage, prompt_tokens, completion_tokens, time.perf_counter() - start)
+        s.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, retries=retries)
+    return response
+
+
+def use_stub(prompt, stage='unspecified', **inputs):
+    """
+    Offline stand-in for use_groq (see Stub_llm.py): a well-formed response
+    synthesized from `inputs`, with the configured latency and injected
+    errors, going through the same retries, tracing and token accounting.
+    """
+    stub = get_stub()
+    with span('use_stub', model=STUB_MODEL_NAME, stage=stage) as s:
+        start = time.perf_counter()
+        response, retries = _invoke_with_retries(lambda: stub.invoke(prompt, stage, **inputs), stage)
+        prompt_tokens, completion_tokens = response_token_usage(response, prompt)
+        ledger.record(stage, prompt_tokens, completion_tokens, time.perf_counter() - start)
+        s.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, retries=retries)
     return response
 
 
-def use_deberta(answer, rubric_dict):
+def get_qa_pipeline(model_name=DEBERTA_MODEL_NAME):
+    """Return a cached question-answering pipeline for `model_name`."""
+    key = ('qa', model_name)
+    with _MODEL_CACHE_LOCK:
+        annotate(cache='hit' if key in _MODEL_CACHE else 'miss')
+        if key not in _MODEL_CACHE:
+            model, tokenizer = load_qa_model(model_name)
+            _MODEL_CACHE[key] = pipeline(
+                "question-answering",
+                model=model,
+                tokenizer=tokenizer,
+                handle_impossible_answer=False,
+                max_answer_len=200,
+            )
+        return _MODEL_CACHE[key]
+
+
+def get_sentence_model(model_name=EMBEDDING_MODEL_NAME):
+    """Return a cached SentenceTransformer for `model_name`."""
+    key = ('embedding', model_name)
+    with _MODEL_CACHE_LOCK:
+        annotate(cache='hit' if key in _MODEL_CACHE else 'miss')
+        if key not in _MODEL_CACHE:
+            model = load_shared(
+                lambda: SentenceTransformer(model_name, local_files_only=OFFLINE or is_local_checkpoint(model_name)),
+                lambda wrapper: wrapper[0].auto_model, model_name, AutoModel,
+            )
+            _MODEL_CACHE[key] = model
+        return _MODEL_CACHE[key]
+
+
+def _format_segments(rubric_points, parts):
+    """Render rubric points and extracted parts in the <start>...<end> segment format."""
+    output = ["<start>"]
+    for rubric_point, part in zip(rubric_points, parts):
+        output.append(f"    Rubric: {rubric_point}")
+        output.append(f"    corresponding_part: {part}")
+        output.append("    ####")
+    output.append("<end>")
+    return "\n".join(output)
+
+
+def _ensure_punkt():
+    try:
+        nltk.data.find("tokenizers/punkt")
+    except LookupError:
+        nltk.download("punkt", quiet=True)
+    try:
+        nltk.data.find("tokenizers/punkt_tab")
+    except LookupError:
+        nltk.download("punkt_tab", quiet=True)
+
+
+def get_cross_encoder(model_name=RERANK_MODEL_NAME):
+    """Return a cached CrossEncoder reranker for `model_name`."""
+    key = ('rerank', model_name)
+    with _MODEL_CACHE_LOCK:
+        annotate(cache='hit' if key in _MODEL_CACHE else 'miss')
+        if key not in _MODEL_CACHE:
+            model = load_shared(
+                lambda: CrossEncoder(model_name, device='cpu', local_files_only=OFFLINE or is_local_checkpoint(model_name)),
+                lambda wrapper: wrapper.model, model_name, AutoModelForSequenceClassification,
+            )
+            _MODEL_CACHE[key] = model
+        return _MODEL_CACHE[key]
+
+
+def verify_local_models():
+    """
+    Checks that every local segmentation model can be loaded offline.
+    Returns {label: problem}; empty when all are available.
+    """
+    return verify_checkpoints({
+        "deberta": DEBERTA_MODEL_NAME,
+        "embedding_model": EMBEDDING_MODEL_NAME,
+        "embedding_rerank": RERANK_MODEL_NAME,
+    })
+
+
+@traced(model=DEBERTA_MODEL_NAME)
+def use_deberta(answer, rubric_dict, checkpoint=DEBERTA_MODEL_NAME):
     """
     Uses RoBERTa QA model to extract relevant answer segments for each rubric point.
     Returns text in the same <start>...<end> format for parser compatibility.
+    `checkpoint` may be a hub name or a local fine-tuned checkpoint directory.
     """
+    return use_deberta_batch([(answer, rubric_dict)], checkpoint=checkpoint)[0]
 
-    model_name = "deepset/deberta-v3-large-squad2"#"deepset/roberta-large-squad2"
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForQuestionAnswering.from_pretrained(model_name)
 
-    qa_pipeline = pipeline(
-        "question-answering",
-        model=model,
-        tokenizer=tokenizer,
-        handle_impossible_answer=False,
-        max_answer_len=200,
-    )
+@traced(model=DEBERTA_MODEL_NAME)
+def use_deberta_batch(items, batch_size=8, checkpoint=DEBERTA_MODEL_NAME, max_tokens=QA_TOKEN_BUDGET):
+    """
+    Batched version of use_deberta.
 
-    formatted_output = ["<start>"]
+    QA pairs are bucketed by token length and batched under a padded-token
+    budget (`max_tokens`), so short answers are not padded to the longest
+    one; results are restored to input order. `max_tokens=None` falls back
+    to arrival-order batches of `batch_size`.
 
-    for rubric_point, _ in rubric_dict.items():
-        try:
-            qa_input = {"question": rubric_point, "context": answer}
-            res = qa_pipeline(qa_input)
-            extracted = res.get("answer", "").strip()
-            if not extracted: #or res.get("score", 0) < 0.1:
-                extracted = "Not addressed"
-        except Exception:
-            extracted = "Not addressed"
+    Args:
+        items (list): (answer, rubric_dict) pairs.
+        batch_size (int): Forward-pass batch size when not bucketing.
+        checkpoint (str): Hub name or local checkpoint directory of the QA model.
+        max_tokens (int): Padded-token budget per forward pass.
 
-        formatted_output.append(f"    Rubric: {rubric_point}")
-        formatted_output.append(f"    corresponding_part: {extracted}")
-        formatted_output.append("    ####")
+    Returns:
+        list: One <start>...<end> segment string per item, in input order.
+    """
+    qa_pipeline = get_qa_pipeline(checkpoint)
+
+    # Flatten every (rubric point, answer) pair so the pipeline sees one batch
+    questions, contexts = [], []
+    for answer, rubric_dict in items:
+        for rubric_point in rubric_dict.keys():
+            questions.append(rubric_point)
+            contexts.append(answer)
 
-    formatted_output.append("<end>")
-    return "\n".join(formatted_output)
+    def run_qa(pairs):
+        out = qa_pipeline(question=[q for q, _ in pairs], context=[c for _, c in pairs], batch_size=len(pairs))
+        return [out] if isinstance(out, dict) else out
+
+    try:
+        pairs = list(zip(questions, contexts))
+        if max_tokens is None:
+            batches = fixed_size_batches(len(pairs), batch_size)
+        else:
+            # Context length is shared by every rubric point of an answer: tokenize once per answer
+            tokenizer = qa_pipeline.tokenizer
+            max_len = getattr(tokenizer, "model_max_length", 384)
+            context_lengths = {c: len(tokenizer(c, add_special_tokens=False)["input_ids"]) for c in set(contexts)}
+            lengths = [
+                min(len(tokenizer(q, add_special_tokens=False)["input_ids"]) + context_lengths[c] + 3, 384, max_len)
+                for q, c in pairs
+            ]
+            batches = token_budget_batches(lengths, max_tokens)
+        results = run_batched(pairs, batches, run_qa)
+    except Exception:
+        # Fall back to one pair at a time so a single bad input doesn't fail the batch
+        results = []
+        for question, context in zip(questions, contexts):
+            try:
+                results.append(qa_pipeline({"question": question, "context": context}))
+            except Exception:
+                results.append({})
+
+    outputs = []
+    pos = 0
+    for answer, rubric_dict in items:
+        parts = []
+        for _ in rubric_dict:
+            extracted = results[pos].get("answer", "").strip()
+            if not extracted: #or res.get("score", 0) < 0.1:
+                extracted = "Not addressed"
+            parts.append(extracted)
+            pos += 1
+        outputs.append(_format_segments(list(rubric_dict.keys()), parts))
+    return outputs
 
 def extract_relevant_passages(answer, rubric_dict, top_k=3):
     # nltk.download('punkt')
@@ -82,7 +297,7 @@ def extract_relevant_passages(answer, rubric_dict, top_k=3):
         nltk.data.find("tokenizers/punkt_tab")
     except LookupError:
         nltk.download("punkt_tab", quiet=True)
-    model = SentenceTransformer('all-mpnet-base-v2')
+    model = get_sentence_model()
     sentences = nltk.sent_tokenize(answer)
     sentence_embeddings = model.encode(sentences, convert_to_tensor=True)
     
@@ -99,51 +314,147 @@ def extract_relevant_passages(answer, rubric_dict, top_k=3):
         output.append("    ####")
     output.append("<end>")
     return "\n".join(output)
+@traced(model=EMBEDDING_MODEL_NAME)
 def extract_relevant_passages_2(answer, rubric_dict, top_k=3):
     """
     Improved version: ensures that each sentence in the student's answer
     is assigned to at most one rubric point.
     """
+    return extract_relevant_passages_batch([(answer, rubric_dict)], top_k=top_k)[0]
 
-    # Ensure sentence tokenizer availability
-    try:
-        nltk.data.find("tokenizers/punkt")
-    except LookupError:
-        nltk.download("punkt", quiet=True)
-    try:
-        nltk.data.find("tokenizers/punkt_tab")
-    except LookupError:
-        nltk.download("punkt_tab", quiet=True)
 
-    # Initialize model and encode once
-    model = SentenceTransformer('all-mpnet-base-v2')
-    sentences = nltk.sent_tokenize(answer)
-    sentence_embeddings = model.encode(sentences, convert_to_tensor=True)
-
-    used_mask = torch.zeros(len(sentences), dtype=torch.bool)
-    output = ["<start>"]
-
-    for rubric_point in rubric_dict.keys():
-        rubric_embedding = model.encode(rubric_point, convert_to_tensor=True)
-        cosine_scores = util.cos_sim(rubric_embedding, sentence_embeddings)[0]
-
-        # Mask already-used sentences
-        cosine_scores[used_mask] = -1e9
-
-        # Get top-k available sentences
-        top_indices = cosine_scores.topk(min(top_k, (~used_mask).sum())).indices.tolist()
+@traced(model=RERANK_MODEL_NAME)
+def extract_relevant_passages_reranked(answer, rubric_dict, top_k=3, candidates=8):
+    """
+    Two-stage version of extract_relevant_passages_2: the bi-encoder recalls
+    `candidates` sentences per rubric point and a cross-encoder reranks them.
+    """
+    return extract_relevant_passages_batch([(answer, rubric_dict)], top_k=top_k, rerank=True, candidates=candidates)[0]
 
-        # Mark selected as used
-        used_mask[top_indices] = True
 
-        relevant_parts = " ".join([sentences[i] for i in top_indices]) if top_indices else "Not addressed"
+def encode_bucketed(model, texts, max_tokens=EMBEDDING_TOKEN_BUDGET):
+    """
+    SentenceTransformer.encode with token-budget batches of similar-length
+    texts instead of a fixed batch size. Returns a tensor in input order.
+    """
+    if max_tokens is None:
+        return model.encode(texts, convert_to_tensor=True)
+    max_len = model.get_max_seq_length() or 512
+    lengths = [min(len(ids), max_len) for ids in model.tokenizer(texts, add_special_tokens=True)["input_ids"]]
+    encode = lambda batch: list(model.encode(batch, batch_size=len(batch), convert_to_tensor=True))
+    return torch.stack(run_batched(texts, token_budget_batches(lengths, max_tokens), encode))
 
-        output.append(f"    Rubric: {rubric_point}")
-        output.append(f"    corresponding_part: {relevant_parts}")
-        output.append("    ####")
 
-    output.append("<end>")
-    return "\n".join(output)
+@traced(model=EMBEDDING_MODEL_NAME)
+def extract_relevant_passages_batch(items, top_k=3, rerank=False, candidates=8, max_tokens=EMBEDDING_TOKEN_BUDGET,
+                                    embedding_store=None, sentence_rows=None):
+    """
+    Batched version of extract_relevant_passages_2.
+
+    Sentences of all answers and all rubric points are encoded in two model
+    calls; the greedy one-sentence-per-rubric-point assignment then runs per
+    answer on the precomputed scores.
+
+    With `rerank=True`, only the top `candidates` sentences per rubric point
+    (by bi-encoder cosine) are eligible, and they are scored by a cross-encoder
+    in a single batched pass over all items, so reranking cost grows with
+    candidates x rubric points rather than sentences x rubric points. A
+    rubric point whose candidates were all taken by earlier points falls back
+    to the bi-encoder cosine over the unused sentences, as without reranking.
+
+    Args:
+        items (list): (answer, rubric_dict) pairs.
+        top_k (int): Maximum sentences assigned to each rubric point.
+        rerank (bool): Rerank bi-encoder candidates with the cross-encoder.
+        candidates (int): Sentences recalled per rubric point when reranking.
+        max_tokens (int): Padded-token budget per encoder batch (None = fixed batches).
+        embedding_store: Optional Streaming.EmbeddingStore; the sentence
+            embeddings computed here are appended to it.
+        sentence_rows (list): With `embedding_store`, receives one
+            (first row, end row) range of sentence embeddings per item.
+
+    Returns:
+        list: One <start>...<end> segment string per item, in input order.
+    """
+    _ensure_punkt()
+    model = get_sentence_model()
+
+    sentences_per_item = [nltk.sent_tokenize(answer) for answer, _ in items]
+    points_per_item = [list(rubric_dict.keys()) for _, rubric_dict in items]
+    all_sentences = [sent for sentences in sentences_per_item for sent in sentences]
+    all_points = [point for points in points_per_item for point in points]
+
+    sentence_embeddings = encode_bucketed(model, all_sentences, max_tokens) if all_sentences else None
+    rubric_embeddings = encode_bucketed(model, all_points, max_tokens) if all_points else None
+
+    if embedding_store is not None:
+        row = embedding_store.append(sentence_embeddings.cpu().numpy()) if all_sentences else len(embedding_store)
+        for sentences in sentences_per_item:
+            if sentence_rows is not None:
+                sentence_rows.append((row, row + len(sentences)))
+            row += len(sentences)
+
+    # Stage 1: cosine matrix per item (rows = rubric points, cols = sentences)
+    score_matrices, eligible_matrices = [], []
+    rerank_pairs, rerank_slots = [], []
+    sent_pos = point_pos = 0
+    for item_idx, (sentences, points) in enumerate(zip(sentences_per_item, points_per_item)):
+        n_sent, n_points = len(sentences), len(points)
+        if n_sent and n_points:
+            cosine_matrix = util.cos_sim(
+                rubric_embeddings[point_pos:point_pos + n_points],
+                sentence_embeddings[sent_pos:sent_pos + n_sent],
+            )
+            if rerank:
+                recalled = cosine_matrix.topk(min(candidates, n_sent), dim=1).indices
+                eligible = torch.zeros_like(cosine_matrix, dtype=torch.bool)
+                eligible.scatter_(1, recalled, True)
+                for row, cols in enumerate(recalled.tolist()):
+                    for col in cols:
+                        rerank_pairs.append((points[row], sentences[col]))
+                        rerank_slots.append((item_idx, row, col))
+            else:
+                eligible = torch.ones_like(cosine_matrix, dtype=torch.bool)
+            score_matrices.append(cosine_matrix)
+            eligible_matrices.append(eligible)
+        else:
+            score_matrices.append(None)
+            eligible_matrices.append(None)
+        sent_pos += n_sent
+        point_pos += n_points
+
+    # Stage 2: one cross-encoder pass over every recalled (rubric point, sentence) pair
+    if rerank and rerank_pairs:
+        rerank_scores = get_cross_encoder().predict(rerank_pairs, batch_size=64, show_progress_bar=False)
+        for (item_idx, row, col), score in zip(rerank_slots, rerank_scores):
+            score_matrices[item_idx][row, col] = float(score)
+
+    outputs = []
+    for sentences, points, score_matrix, eligible in zip(sentences_per_item, points_per_item, score_matrices, eligible_matrices):
+        if score_matrix is None:
+            outputs.append(_format_segments(points, ["Not addressed"] * len(points)))
+            continue
+        used_mask = torch.zeros(len(sentences), dtype=torch.bool)
+        parts = []
+        for row in range(len(points)):
+            scores = score_matrix[row].clone()
+
+            # Mask already-used (and, when reranking, non-recalled) sentences
+            available = eligible[row] & ~used_mask
+            if not available.any():
+                # recalled candidates all used: non-recalled scores are still cosine
+                available = ~used_mask
+            scores[~available] = -1e9
+
+            # Get top-k available sentences
+            top_indices = scores.topk(min(top_k, int(available.sum()))).indices.tolist()
+
+            # Mark selected as used
+            used_mask[top_indices] = True
+
+            parts.append(" ".join([sentences[i] for i in top_indices]) if top_indices else "Not addressed")
+        outputs.append(_format_segments(points, parts))
+    return outputs
 
 if __name__ == "__main__":
     question="write 10 lines on generative AI"
@@ -0,0 +1,64 @@
+import json
+import os
+import urllib.error
+import urllib.request
+
+from Parsers import parse_answer_segments
+
+GRADING_SERVER_URL = os.getenv("GRADING_SERVER_URL", "http://127.0.0.1:8000")
+REQUEST_TIMEOUT_S = float(os.getenv("GRADING_SERVER_TIMEOUT", "300"))
+
+# Same call signatures as Automations.py, so App.py can use either module.
+
+
+def _request(path, payload=None):
+    url = GRADING_SERVER_URL.rstrip("/") + path
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT_S) as resp:
+            return json.loads(resp.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        try:
+            detail = json.loads(e.read().decode("utf-8")).get("detail", e.reason)
+        except Exception:
+            detail = e.reason
+        if e.code == 400:
+            raise ValueError(detail)
+        raise RuntimeError(f"Grading server error {e.code}: {detail}")
+
+
+def generate_rubric_2(question, marks, demo_answers="", endpoint='groq'):
+    return _request("/rubric", {"question": question, "marks": int(marks), "demo_answers": demo_answers or "", "endpoint": endpoint})["raw"]
+
+
+def generate_rubric_consensus(question, marks, demo_answers="", n=3, merge=False, endpoint='groq'):
+    out = _request("/rubric_consensus", {"question": question, "marks": int(marks), "demo_answers": demo_answers or "", "n": int(n), "merge": bool(merge), "endpoint": endpoint})
+    return out["raw"], out["rubric"], out["report"]
+
+
+def break_answer_into_points(answer, rubric, endpoint='groq'):
+    return _request("/segment", {"answer": answer, "rubric": dict(rubric), "endpoint": endpoint})["raw"]
+
+
+def ai_grade_segments(answer, rubric, segments, endpoint='groq', question=None):
+    return _request("/score", {"answer": answer, "rubric": dict(rubric), "segments": dict(segments), "endpoint": endpoint, "question": question})["scores"]
+
+
+def suggest_rubric_modification(answer, rubric, endpoint='groq'):
+    return _request("/suggest", {"answer": answer, "rubric": dict(rubric), "endpoint": endpoint})["raw"]
+
+
+def process_answer(answer, rubric, endpoint='groq', scoring_endpoint='groq', question=None):
+    segments = parse_answer_segments(break_answer_into_points(answer, rubric, endpoint=endpoint))
+    scores = ai_grade_segments(answer, rubric, segments, endpoint=scoring_endpoint, question=question)
+    return segments, scores
+
+
+def embed_answers(answers):
+    """Normalized MPNet embeddings of `answers`, computed by the server (see Answer_index)."""
+    return _request("/embed", {"answers": list(answers)})["embeddings"]
+
+
+def usage_report():
+    return _request("/usage")["report"]
@@ -0,0 +1,228 @@
+"""
+Local grading service.
+
+Holds one warm copy of each local model for every connected grader and
+batches concurrent segmentation requests that arrive within a short window
+into a single model call. Run a single worker so the models are shared:
+
+    uvicorn Grading_server:app --host 127.0.0.1 --port 8000
+
+and start the app as a thin client with GRADING_SERVER_URL=http://127.0.0.1:8000.
+"""
+import asyncio
+import functools
+import os
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel
+
+from Automations import (
+    generate_rubric_2,
+    generate_rubric_consensus,
+    break_answer_into_points,
+    ai_grade_segments,
+    suggest_rubric_modification,
+)
+from Generative_models import (
+    get_qa_pipeline,
+    get_sentence_model,
+    get_cross_encoder,
+    verify_local_models,
+    use_deberta_batch,
+    extract_relevant_passages_batch,
+)
+from Token_budget import ledger
+from Checkpoints import OFFLINE
+
+BATCH_WINDOW_MS = float(os.getenv("GRADER_BATCH_WINDOW_MS", "20"))
+MAX_BATCH_SIZE = int(os.getenv("GRADER_MAX_BATCH_SIZE", "16"))
+WARM_MODELS = os.getenv("GRADER_WARM_MODELS", "1") != "0"
+
+
+class MicroBatcher:
+    """
+    Collects items submitted from concurrent requests and runs them through
+    `batch_fn` together. A batch closes when it reaches `max_batch_size`
+    items or `max_wait_ms` after its first item arrived, whichever is first.
+    `batch_fn` receives a list of items and must return results in order.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=BATCH_WINDOW_MS):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.items = 0
+        self._queue = None
+        self._task = None
+
+    async def submit(self, item):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = await loop.run_in_executor(None, self.batch_fn, [item for item, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
+
+
+# Local endpoints share one model each and benefit from batching; Groq
+# calls are independent HTTP requests and just run in the thread pool.
+batchers = {
+    "deberta": MicroBatcher(use_deberta_batch),
+    "embedding_model": MicroBatcher(extract_relevant_passages_batch),
+    "embedding_rerank": MicroBatcher(functools.partial(extract_relevant_passages_batch, rerank=True)),
+}
+# Answer embeddings for Answer_index near-duplicate lookups from thin clients
+embedder = MicroBatcher(lambda answers: get_sentence_model().encode(answers, normalize_embeddings=True).tolist())
+
+app = FastAPI(title="Subjective Grading Assistant")
+
+
+class RubricRequest(BaseModel):
+    question: str
+    marks: int
+    demo_answers: str = ""
+    endpoint: str = "groq"
+
+
+class RubricConsensusRequest(RubricRequest):
+    n: int = 3
+    merge: bool = False
+
+
+class SegmentRequest(BaseModel):
+    answer: str
+    rubric: Dict[str, int]
+    endpoint: str = "groq"
+
+
+class ScoreRequest(BaseModel):
+    answer: str
+    rubric: Dict[str, int]
+    segments: Dict[str, str]
+    endpoint: str = "groq"
+    question: Optional[str] = None
+
+
+class EmbedRequest(BaseModel):
+    answers: List[str]
+
+
+class SuggestRequest(BaseModel):
+    answer: str
+    rubric: Dict[str, int]
+    endpoint: str = "groq"
+
+
+async def _run_blocking(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(None, lambda: fn(*args, **kwargs))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.on_event("startup")
+async def _warm_models():
+    if OFFLINE:
+        problems = verify_local_models()
+        if problems:
+            raise RuntimeError(f"Models not available offline: {problems}")
+    if WARM_MODELS:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, get_qa_pipeline)
+        await loop.run_in_executor(None, get_sentence_model)
+        await loop.run_in_executor(None, get_cross_encoder)
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "batching": {name: b.stats() for name, b in {**batchers, "embed": embedder}.items()}}
+
+
+@app.get("/usage")
+async def usage():
+    return {"report": ledger.report(), "by_stage": ledger.by_stage()}
+
+
+@app.post("/rubric")
+async def rubric(req: RubricRequest):
+    raw = await _run_blocking(generate_rubric_2, req.question, req.marks, req.demo_answers, endpoint=req.endpoint)
+    return {"raw": raw}
+
+
+@app.post("/rubric_consensus")
+async def rubric_consensus(req: RubricConsensusRequest):
+    raw, rubric, report = await _run_blocking(
+        generate_rubric_consensus, req.question, req.marks, req.demo_answers, n=req.n, merge=req.merge, endpoint=req.endpoint
+    )
+    return {"raw": raw, "rubric": rubric, "report": report}
+
+
+@app.post("/segment")
+async def segment(req: SegmentRequest):
+    batcher: Optional[MicroBatcher] = batchers.get(req.endpoint)
+    if batcher is not None:
+        raw = await batcher.submit((req.answer, req.rubric))
+    else:
+        raw = await _run_blocking(break_answer_into_points, req.answer, req.rubric, endpoint=req.endpoint)
+    return {"raw": raw}
+
+
+@app.post("/score")
+async def score(req: ScoreRequest):
+    scores = await _run_blocking(
+        ai_grade_segments, req.answer, req.rubric, req.segments, endpoint=req.endpoint, question=req.question
+    )
+    return {"scores": scores}
+
+
+@app.post("/embed")
+async def embed(req: EmbedRequest):
+    embeddings = await asyncio.gather(*(embedder.submit(answer) for answer in req.answers))
+    return {"embeddings": list(embeddings)}
+
+
+@app.post("/suggest")
+async def suggest(req: SuggestRequest):
+    raw = await _run_blocking(suggest_rubric_modification, req.answer, req.rubric, endpoint=req.endpoint)
+    return {"raw": raw}
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=os.getenv("GRADER_HOST", "127.0.0.1"), port=int(os.getenv("GRADER_PORT", "8000")), workers=1)
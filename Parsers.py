@@ -1,7 +1,18 @@
 import os
 import re
 from collections import OrderedDict
+from Tracing import traced
 
+# Shared by rubric agreement, score calibration features and the stub endpoint
+STOPWORDS = frozenset({'a', 'an', 'and', 'the', 'of', 'to', 'in', 'on', 'for', 'with', 'its', 'their', 'about',
+                       'is', 'are', 'or', 'how', 'what'})
+
+
+def word_stems(text):
+    """Content words of `text` cut to 5-char prefixes, so 'ethics'/'ethical' or 'define'/'definition' match."""
+    return frozenset(w[:5] for w in re.findall(r'[a-z0-9]+', (text or "").lower()) if w not in STOPWORDS)
+
+@traced()
 def parse_answer_segments(response_content):
     rubric_dict = OrderedDict()
 
@@ -33,6 +44,7 @@ def parse_answer_segments(response_content):
 
 
 
+@traced()
 def parse_rubric(response_content):
     rubric_dict = {}
     # Find the content between <start> and <end>
@@ -67,6 +79,17 @@ def parse_rubric(response_content):
 
     return rubric_dict
 
+def format_rubric(rubric_dict):
+    """Inverse of parse_rubric: render {criterion: marks} in the <start>...<end> rubric format."""
+    lines = ["<start>"]
+    for rubric_text, marks in rubric_dict.items():
+        lines.append(f"Rubric: {rubric_text}")
+        lines.append(f"Marks: {marks}")
+        lines.append("####")
+    lines.append("<end>")
+    return "\n".join(lines)
+
+@traced()
 def parse_tentative_scores(response_content):
     scores = {}
     start_index = response_content.find('<start>')
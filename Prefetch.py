@@ -0,0 +1,108 @@
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+from Token_budget import ledger
+
+
+@dataclass
+class PrefetchedAnswer:
+    index: int
+    answer: str
+    segments: dict = field(default_factory=dict)
+    scores: dict = field(default_factory=dict)
+    error: Optional[Exception] = None
+
+
+class AnswerPrefetcher:
+    """
+    Segments and scores a queue of answers in a background thread.
+
+    At most `depth` processed answers wait in the hand-off queue, so the
+    worker stays a bounded number of answers ahead of the instructor.
+    Results come back in submission order through `next()`.
+
+    `process_fn(answer, rubric, endpoint=...)` defaults to
+    Automations.process_answer; pass Grading_client.process_answer to
+    prefetch through the grading server instead.
+    """
+
+    _DONE = object()
+
+    def __init__(self, answers, rubric, endpoint='groq', depth=2, process_fn=None, start=0):
+        if depth < 1:
+            raise ValueError("Prefetch depth must be at least 1.")
+        if process_fn is None:
+            from Automations import process_answer as process_fn
+        self.process_fn = process_fn
+        self.answers = list(answers)
+        self.rubric = dict(rubric)
+        self.endpoint = endpoint
+        self.depth = depth
+        self.start = start  # index of the first answer to process
+        self._next_index = start  # first answer not yet handed out
+        self._results = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._exhausted = False
+        # LLM usage of the whole queue is reported as one ledger batch
+        self._thread = threading.Thread(target=ledger.batch_context('prefetch').run, args=(self._worker,), daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self.answers)
+
+    def _put(self, item):
+        # Block while the queue is full, but wake up regularly to honour stop().
+        while not self._stop.is_set():
+            try:
+                self._results.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self):
+        for idx in range(self.start, len(self.answers)):
+            answer = self.answers[idx]
+            if self._stop.is_set():
+                return
+            try:
+                segments, scores = self.process_fn(answer, self.rubric, endpoint=self.endpoint)
+                item = PrefetchedAnswer(idx, answer, segments, scores)
+            except Exception as e:
+                item = PrefetchedAnswer(idx, answer, error=e)
+            if not self._put(item):
+                return
+        self._put(self._DONE)
+
+    def ready(self):
+        """Number of processed answers waiting to be picked up."""
+        return self._results.qsize()
+
+    def next(self, timeout=None):
+        """
+        Returns the next PrefetchedAnswer, blocking until it is ready.
+        Returns None once every answer has been handed out.
+        """
+        if self._exhausted:
+            return None
+        item = self._results.get(timeout=timeout)
+        if item is self._DONE:
+            self._exhausted = True
+            return None
+        self._next_index = item.index + 1
+        return item
+
+    def restarted(self, rubric):
+        """
+        Stops this prefetcher and returns a new one that re-processes every
+        answer not yet handed out with `rubric` (e.g. after the rubric was edited).
+        """
+        self.stop()
+        return AnswerPrefetcher(self.answers, rubric, self.endpoint, self.depth, self.process_fn, start=self._next_index)
+
+    def stop(self):
+        """Stops the worker after its current answer; pending results are dropped."""
+        self._stop.set()
+        self._exhausted = True
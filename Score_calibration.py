@@ -0,0 +1,276 @@
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from Parsers import word_stems
+
+OVERRIDES_PATH = os.getenv("GRADER_OVERRIDES_PATH", "instructor_scores.jsonl")
+CALIBRATION_PATH = os.getenv("GRADER_CALIBRATION_PATH", "score_calibration.json")
+
+FEATURE_NAMES = [
+    "bias",
+    "not_addressed",
+    "criterion_recall",  # share of criterion words found in the segment
+    "segment_jaccard",
+    "log_segment_words",
+    "segment_share",  # segment length / answer length
+    "sentences",
+]
+
+
+def question_key(question):
+    return hashlib.md5((question or "").strip().encode("utf-8")).hexdigest()[:12]
+
+
+def criterion_features(criterion, segment, answer):
+    """Cheap per-criterion features from the rubric text, extracted segment and answer."""
+    segment = segment or ""
+    not_addressed = not segment.strip() or segment.strip().lower().startswith("not addressed")
+    if not_addressed:
+        return [1.0, 1.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+    crit, seg = word_stems(criterion), word_stems(segment)
+    words = len(segment.split())
+    return [
+        1.0,
+        0.0,
+        len(crit & seg) / len(crit) if crit else 0.0,
+        len(crit & seg) / len(crit | seg) if crit | seg else 0.0,
+        math.log1p(words),
+        min(1.0, len(segment) / max(1, len(answer or ""))),
+        float(len(re.findall(r"[.!?](\s|$)", segment)) or 1),
+    ]
+
+
+def record_final_scores(question, rubric, answer, segments, ai_scores, final_scores, endpoint='groq', path=OVERRIDES_PATH,
+                        scoring_endpoint='groq', student_id=None):
+    """Append one row per criterion with the AI tentative and instructor-final scores."""
+    ts = time.time()
+    with open(path, "a", encoding="utf-8") as f:
+        for criterion, max_marks in rubric.items():
+            if criterion not in final_scores:
+                continue
+            f.write(json.dumps({
+                "student_id": student_id,
+                "question_key": question_key(question),
+                "question": question,
+                "criterion": criterion,
+                "max_marks": max_marks,
+                "segment": segments.get(criterion, "Not addressed"),
+                "answer": answer,
+                "ai_score": ai_scores.get(criterion),
+                "final_score": final_scores[criterion],
+                "endpoint": endpoint,
+                "scoring_endpoint": scoring_endpoint,
+                "timestamp": ts,
+            }, ensure_ascii=False) + "\n")
+
+
+def _record_key(record):
+    answer = hashlib.md5(" ".join((record.get("answer") or "").split()).encode("utf-8")).hexdigest()
+    return record.get("question_key"), record.get("student_id"), answer, record.get("criterion")
+
+
+def iter_records(path=OVERRIDES_PATH):
+    """
+    Saved rows one at a time (for exports that must not load the whole file).
+    Saving the same answer again replaces its earlier rows: only the last
+    row per (question, student, answer, criterion) is yielded.
+    """
+    if not os.path.exists(path):
+        return
+    last = {}
+    with open(path, encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if line.strip():
+                last[_record_key(json.loads(line))] = i
+    keep = set(last.values())
+    with open(path, encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if i in keep:
+                yield json.loads(line)
+
+
+def load_records(path=OVERRIDES_PATH):
+    return list(iter_records(path))
+
+
+def _solve(a, b):
+    """Solve a x = b for a small dense system (Gaussian elimination with pivoting)."""
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        m[col], m[pivot] = m[pivot], m[col]
+        if abs(m[col][col]) < 1e-12:
+            continue
+        for r in range(n):
+            if r != col:
+                factor = m[r][col] / m[col][col]
+                for c in range(col, n + 1):
+                    m[r][c] -= factor * m[col][c]
+    return [m[i][n] / m[i][i] if abs(m[i][i]) > 1e-12 else 0.0 for i in range(n)]
+
+
+def _fit_ridge(xs, ys, l2):
+    """Ridge regression weights (bias not penalised)."""
+    d = len(FEATURE_NAMES)
+    a = [[sum(x[i] * x[j] for x in xs) + (l2 if i == j and i > 0 else 0.0) for j in range(d)] for i in range(d)]
+    b = [sum(x[i] * y for x, y in zip(xs, ys)) for i in range(d)]
+    return _solve(a, b)
+
+
+class ScoreCalibrator:
+    """
+    Linear model predicting the instructor's final score (as a fraction of the
+    criterion's marks) from cheap segment features. One model per question
+    once it has `min_samples` stored overrides, with a global fallback.
+    """
+
+    def __init__(self, l2=1.0, min_samples=20):
+        self.l2 = l2
+        self.min_samples = min_samples
+        self.global_weights = None
+        self.question_weights = {}
+
+    def fit(self, records):
+        rows = [r for r in records if r.get("max_marks")]
+        if not rows:
+            raise ValueError("No instructor scores to fit the calibration model on.")
+        features = lambda r: criterion_features(r["criterion"], r["segment"], r["answer"])
+        target = lambda r: float(r["final_score"]) / float(r["max_marks"])
+        self.global_weights = _fit_ridge([features(r) for r in rows], [target(r) for r in rows], self.l2)
+        by_question = defaultdict(list)
+        for r in rows:
+            by_question[r["question_key"]].append(r)
+        self.question_weights = {
+            key: _fit_ridge([features(r) for r in group], [target(r) for r in group], self.l2)
+            for key, group in by_question.items() if len(group) >= self.min_samples
+        }
+        return self
+
+    def predict(self, criterion, max_marks, segment, answer, question=None):
+        weights = self.question_weights.get(question_key(question), self.global_weights) if question else self.global_weights
+        if weights is None:
+            raise ValueError("Calibration model is not fitted.")
+        x = criterion_features(criterion, segment, answer)
+        fraction = min(1.0, max(0.0, sum(w * v for w, v in zip(weights, x))))
+        return round(fraction * max_marks * 2) / 2  # same 0.5 step as the app's score inputs
+
+    def grade_segments(self, answer, rubric, segments, question=None):
+        """Drop-in for ai_grade_segments: {rubric_point: tentative_score}."""
+        return {
+            criterion: self.predict(criterion, max_marks, segments.get(criterion, "Not addressed"), answer, question)
+            for criterion, max_marks in rubric.items()
+        }
+
+    def save(self, path=CALIBRATION_PATH):
+        with open(path, "w") as f:
+            json.dump({
+                "features": FEATURE_NAMES,
+                "l2": self.l2,
+                "min_samples": self.min_samples,
+                "global_weights": self.global_weights,
+                "question_weights": self.question_weights,
+            }, f, indent=2)
+
+    @classmethod
+    def load(cls, path=CALIBRATION_PATH):
+        with open(path) as f:
+            data = json.load(f)
+        if data["features"] != FEATURE_NAMES:
+            raise ValueError(f"{path} was fitted with different features; refit it.")
+        model = cls(l2=data["l2"], min_samples=data["min_samples"])
+        model.global_weights = data["global_weights"]
+        model.question_weights = data["question_weights"]
+        return model
+
+
+_calibrator = None
+_calibrator_version = None
+_calibrator_lock = threading.Lock()
+
+
+def _mtime(path):
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+def get_calibrator():
+    """
+    Calibration model from CALIBRATION_PATH, refitted from OVERRIDES_PATH
+    when scores were saved after it (or it was never saved). Reloaded
+    whenever either file changes, so newly saved final scores are used
+    without restarting.
+    """
+    global _calibrator, _calibrator_version
+    version = (_mtime(CALIBRATION_PATH), _mtime(OVERRIDES_PATH))
+    with _calibrator_lock:
+        if _calibrator is None or version != _calibrator_version:
+            saved_at, overrides_at = version
+            model = ScoreCalibrator.load(CALIBRATION_PATH) if saved_at is not None else ScoreCalibrator()
+            if saved_at is None or (overrides_at is not None and overrides_at > saved_at):
+                model.fit(load_records(OVERRIDES_PATH))
+            _calibrator, _calibrator_version = model, version
+        return _calibrator
+
+
+def evaluate(records, folds=5, l2=1.0, min_samples=20):
+    """
+    K-fold comparison of calibrated scores and LLM tentative scores against
+    instructor-final scores (mean absolute error in marks), plus the mean
+    inference time per criterion.
+
+    `local_mae` covers every held-out row. The like-for-like comparison is
+    `llm_mae` vs `local_mae_on_llm`, both over the `n_llm` held-out rows
+    whose tentative score came from the Groq LLM (not the local model, the
+    stub or near-duplicate reuse).
+    """
+    rows = [r for r in records if r.get("max_marks")]
+    if len(rows) < folds:
+        raise ValueError(f"Need at least {folds} instructor scores to evaluate, found {len(rows)}.")
+    local_err, llm_err, local_err_on_llm, exact, n_llm = 0.0, 0.0, 0.0, 0, 0
+    predict_time = 0.0
+    for k in range(folds):
+        train = [r for i, r in enumerate(rows) if i % folds != k]
+        test = [r for i, r in enumerate(rows) if i % folds == k]
+        model = ScoreCalibrator(l2=l2, min_samples=min_samples).fit(train)
+        for r in test:
+            start = time.perf_counter()
+            pred = model.predict(r["criterion"], r["max_marks"], r["segment"], r["answer"], r.get("question"))
+            predict_time += time.perf_counter() - start
+            local_err += abs(pred - r["final_score"])
+            exact += pred == r["final_score"]
+            if r.get("ai_score") is not None and r.get("scoring_endpoint") == 'groq':
+                llm_err += abs(float(r["ai_score"]) - r["final_score"])
+                local_err_on_llm += abs(pred - r["final_score"])
+                n_llm += 1
+    n = len(rows)
+    return {
+        "criteria": n,
+        "local_mae": local_err / n,
+        "local_exact_rate": exact / n,
+        "n_llm": n_llm,
+        "llm_mae": llm_err / n_llm if n_llm else None,
+        "local_mae_on_llm": local_err_on_llm / n_llm if n_llm else None,
+        "mean_predict_ms": 1000 * predict_time / n,
+    }
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else OVERRIDES_PATH
+    records = load_records(path)
+    report = evaluate(records)
+    print(f"Evaluated on {report['criteria']} instructor-graded criteria (5-fold):")
+    print(f"  local calibration MAE : {report['local_mae']:.3f} marks ({100 * report['local_exact_rate']:.0f}% exact)")
+    if report["llm_mae"] is not None:
+        print(f"  on the {report['n_llm']} Groq-scored criteria:")
+        print(f"    LLM tentative MAE     : {report['llm_mae']:.3f} marks")
+        print(f"    local calibration MAE : {report['local_mae_on_llm']:.3f} marks")
+    print(f"  local inference       : {report['mean_predict_ms']:.3f} ms per criterion")
+    ScoreCalibrator().fit(records).save(CALIBRATION_PATH)
+    print(f"Saved calibration model to {CALIBRATION_PATH}")
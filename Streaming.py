@@ -0,0 +1,259 @@
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Optional
+
+import numpy as np
+
+from Answer_records import AnswerRecord
+from Token_budget import ledger
+from Tracing import rss_bytes
+
+STREAM_WINDOW = int(os.getenv("GRADER_STREAM_WINDOW", "64"))
+
+
+class EmbeddingStore:
+    """
+    Append-only float32 matrix (one row per embedding) in a memory-mapped file.
+
+    Rows live in the page cache rather than the Python heap, so storing
+    embeddings for any number of sentences does not grow the process's private
+    memory. The file grows `grow_rows` rows at a time; `dim` is taken from
+    the first append when not given.
+    """
+
+    def __init__(self, dim=None, path=None, grow_rows=4096):
+        self.dim = dim
+        self.grow_rows = grow_rows
+        self._owns_file = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=".f32")
+            os.close(fd)
+        self.path = path
+        self._rows = 0
+        self._capacity = 0
+        self._array = None
+
+    def _grow(self, min_capacity):
+        capacity = max(min_capacity, self._capacity + self.grow_rows)
+        if self._array is not None:
+            self._array.flush()
+            self._array = None
+        with open(self.path, "r+b" if self._capacity else "wb") as f:
+            f.truncate(capacity * self.dim * 4)
+        self._array = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        self._capacity = capacity
+
+    def append(self, vectors):
+        """Append a (n, dim) array; returns the row index of the first new row."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[-1]
+        vectors = vectors.reshape(-1, self.dim)
+        start = self._rows
+        if start + len(vectors) > self._capacity:
+            self._grow(start + len(vectors))
+        self._array[start:start + len(vectors)] = vectors
+        self._rows += len(vectors)
+        return start
+
+    def __getitem__(self, index):
+        if self._array is None:
+            raise IndexError("EmbeddingStore is empty")
+        return self._array[:self._rows][index]
+
+    def __len__(self):
+        return self._rows
+
+    def close(self):
+        if self._array is not None:
+            self._array.flush()
+            self._array = None
+        if self._owns_file and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+@dataclass
+class StreamResult:
+    answer_id: object
+    segments: OrderedDict = field(default_factory=OrderedDict)
+    scores: dict = field(default_factory=dict)
+    error: Optional[str] = None
+    sentence_rows: Optional[tuple] = None  # (first, end) rows of its sentence embeddings in the EmbeddingStore
+    record: Optional[AnswerRecord] = None  # compact form, when a CriterionTable was given
+    segment_s: Optional[float] = None
+    score_s: Optional[float] = None
+
+
+def _check_memory(limit_bytes, window, min_window=1):
+    """Halve the window while RSS is above the ceiling; raise if it can't go lower."""
+    if not limit_bytes or rss_bytes() <= limit_bytes:
+        return window
+    gc.collect()
+    if rss_bytes() <= limit_bytes:
+        return window
+    if window <= min_window:
+        raise MemoryError(f"RSS {rss_bytes() / 2**20:.0f} MiB exceeds the {limit_bytes / 2**20:.0f} MiB ceiling")
+    print(f"⚠️ Warning: RSS above {limit_bytes / 2**20:.0f} MiB, shrinking stream window to {window // 2}")
+    return window // 2
+
+
+def grade_stream(answers, rubric, endpoint='embedding_model', scoring_endpoint='groq', question=None,
+                 window=STREAM_WINDOW, max_workers=8, memory_limit_mb=None, embeddings=None, criteria=None):
+    """
+    Grades a stream of answers in fixed-size windows and yields results as they complete.
+
+    Only one window of answers is held at a time: it is segmented (in one
+    batch for the local endpoints, concurrently for Groq/stub), each answer
+    is scored as soon as segmentation finishes, and results are yielded in
+    completion order. Nothing is kept after it has been yielded, so memory
+    stays flat however long the stream is.
+
+    Args:
+        answers (iterable): Answer strings or (answer_id, answer) pairs; may be a generator.
+        rubric (dict): Parsed rubric {criterion: marks}.
+        endpoint (str): Segmentation endpoint.
+        scoring_endpoint (str): Scoring endpoint ('groq', 'stub' or 'local').
+        question (str): Question text, used by the 'local' scoring endpoint.
+        window (int): Answers per window.
+        max_workers (int): Threads for per-answer LLM calls.
+        memory_limit_mb (int): RSS ceiling; the window is halved while above it.
+        embeddings (EmbeddingStore): Embedding endpoints only. The sentence
+            embeddings computed during segmentation are spilled to it, and
+            each result's rows are stored in StreamResult.sentence_rows.
+        criteria (CriterionTable): If given, each result is stored as an
+            AnswerRecord (interned criterion IDs, segment offsets into the
+            answer, float scores) in StreamResult.record instead of the
+            segments/scores dicts, which are set to None.
+
+    Yields:
+        StreamResult
+    """
+    from Automations import break_answer_into_points, ai_grade_segments
+    from Exam import LOCAL_BATCH_FUNCTIONS
+    from Parsers import parse_answer_segments
+
+    limit_bytes = memory_limit_mb * 2**20 if memory_limit_mb else None
+    if embeddings is not None and endpoint not in ('embedding_model', 'embedding_rerank'):
+        raise ValueError(f"Endpoint '{endpoint}' computes no embeddings to spill")
+
+    def segment_one(answer):
+        return break_answer_into_points(answer, rubric, endpoint=endpoint)
+
+    def score(result, answer):
+        start = time.perf_counter()
+        try:
+            result.scores = ai_grade_segments(answer, rubric, result.segments, endpoint=scoring_endpoint, question=question)
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"
+        result.score_s = time.perf_counter() - start
+        if criteria is not None:
+            result.record = AnswerRecord.from_results(result.answer_id, answer, rubric, result.segments, result.scores, criteria)
+            result.segments = result.scores = None
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        answers = iter(answers)
+        position = 0  # arrival-order ids for answers given without one
+        while True:
+            window = _check_memory(limit_bytes, window)
+            batch = [a if isinstance(a, tuple) else (position + i, a) for i, a in enumerate(islice(answers, window))]
+            if not batch:
+                return
+            position += len(batch)
+            results = [StreamResult(answer_id) for answer_id, _ in batch]
+            texts = [answer for _, answer in batch]
+
+            start = time.perf_counter()
+            if endpoint in LOCAL_BATCH_FUNCTIONS:
+                spill = {}
+                if embeddings is not None:
+                    spill = {"embedding_store": embeddings, "sentence_rows": []}
+                try:
+                    raw = LOCAL_BATCH_FUNCTIONS[endpoint]([(answer, rubric) for answer in texts], **spill)
+                except Exception as e:
+                    raw = [e] * len(texts)
+                for result, rows in zip(results, spill.get("sentence_rows", ())):
+                    result.sentence_rows = rows
+            else:
+                futures = [ledger.submit(executor, _capture(segment_one), text, default='stream') for text in texts]
+                raw = [f.result() for f in futures]
+            elapsed = (time.perf_counter() - start) / len(texts)
+
+            pending = []
+            for result, answer, raw_segments in zip(results, texts, raw):
+                result.segment_s = elapsed
+                if isinstance(raw_segments, Exception):
+                    result.error = f"{type(raw_segments).__name__}: {raw_segments}"
+                    yield result
+                    continue
+                result.segments = parse_answer_segments(raw_segments)
+                pending.append(ledger.submit(executor, score, result, answer, default='stream'))
+            del batch, texts, raw, results
+            for future in as_completed(pending):
+                yield future.result()
+
+
+def _capture(fn):
+    """Return exceptions instead of raising them, so one failure doesn't sink its window."""
+    def call(*args):
+        try:
+            return fn(*args)
+        except Exception as e:
+            return e
+    return call
+
+
+def _synthetic_answers(n, seed=0):
+    """Lazily generated answers: the demo answer's sentences resampled per student."""
+    from Automations import demo_answer
+    sentences = [s.strip() for s in demo_answer.strip().split("\n") if s.strip()]
+    for i in range(n):
+        rng = random.Random(seed + i)
+        yield f"student-{i:06d}", " ".join(rng.sample(sentences, rng.randint(2, len(sentences))))
+
+
+def rss_profile(n, rubric, window=STREAM_WINDOW, **kwargs):
+    """Peak RSS (sampled once per window) while streaming `n` synthetic answers."""
+    peak, graded, errors = rss_bytes(), 0, 0
+    for result in grade_stream(_synthetic_answers(n), rubric, window=window, **kwargs):
+        graded += 1
+        errors += result.error is not None
+        if graded % window == 0:
+            peak = max(peak, rss_bytes())
+    return {"answers": graded, "errors": errors, "peak_rss_mib": max(peak, rss_bytes()) / 2**20}
+
+
+if __name__ == "__main__":
+    # python Streaming.py [n] [--models]
+    # Streams n and 10*n answers and compares peak RSS; the stub endpoint
+    # needs no models or API key, --models uses MPNet segmentation and spills
+    # its sentence embeddings to a memory-mapped EmbeddingStore.
+    n = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 1000
+    rubric = {
+        "Defines generative AI": 3,
+        "Describes key technologies": 3,
+        "Discusses applications and ethical concerns": 4,
+    }
+    kwargs = {"endpoint": 'stub', "scoring_endpoint": 'stub'}
+    store = None
+    if "--models" in sys.argv:
+        store = EmbeddingStore()
+        kwargs = {"endpoint": 'embedding_model', "scoring_endpoint": 'stub', "embeddings": store}
+
+    rss_profile(n, rubric, **kwargs)  # warm up imports, models, thread pool and allocator
+    small = rss_profile(n, rubric, **kwargs)
+    large = rss_profile(10 * n, rubric, **kwargs)
+    for label, p in [("1x", small), ("10x", large)]:
+        print(f"{label:>4}: {p['answers']:>7} answers, {p['errors']} errors, peak RSS {p['peak_rss_mib']:.1f} MiB")
+    print(f"RSS growth for 10x the answers: {large['peak_rss_mib'] - small['peak_rss_mib']:+.1f} MiB")
+    if store is not None:
+        print(f"{len(store)} sentence embeddings spilled to {store.path}")
+        store.close()
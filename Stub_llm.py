@@ -0,0 +1,281 @@
+import hashlib
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+from Parsers import format_rubric, parse_rubric, word_stems
+
+# The 'stub' endpoint answers every LLM stage offline with well-formed
+# <start>...<end> responses built from the inputs, so the whole pipeline can
+# be load-tested without GROQ_API_KEY or network access. Behaviour is set
+# with environment variables (or a StubConfig):
+#   GRADER_STUB_LATENCY      fixed:S | uniform:LO,HI | normal:MEAN,SD | lognormal:MEDIAN,SIGMA  (seconds)
+#   GRADER_STUB_TOKENS_PER_S extra latency per completion token (0 = off)
+#   GRADER_STUB_ERROR_RATE   fraction of calls failing with a server error
+#   GRADER_STUB_429_RATE     fraction of calls failing with a rate-limit error
+#   GRADER_STUB_RPM          requests per minute before every call gets a 429 (0 = unlimited)
+#   GRADER_STUB_SEED         seed for latency and error draws
+STUB_MODEL_NAME = "stub"
+
+_CRITERIA_TEMPLATES = [
+    "Defines {topic} accurately",
+    "Explains the key concepts and how {topic} works",
+    "Gives relevant examples or applications of {topic}",
+    "Discusses limitations, risks or ethical concerns of {topic}",
+    "Clarity, coherence and relevance of the answer",
+]
+_INSTRUCTION_WORDS = {'write', 'explain', 'describe', 'discuss', 'define', 'what', 'is', 'are', 'lines', 'on', 'about',
+                      'briefly', 'the', 'a', 'an', 'how', 'why', 'does', 'do', 'give', 'short', 'note', 'notes'}
+
+
+class StubRateLimitError(Exception):
+    """Injected HTTP 429, shaped like the provider's rate-limit error."""
+    status_code = 429
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class StubServerError(Exception):
+    """Injected HTTP 5xx."""
+    status_code = 503
+
+
+class StubResponse:
+    """Minimal stand-in for a LangChain chat response."""
+
+    def __init__(self, content, prompt_tokens, completion_tokens):
+        self.content = content
+        self.usage_metadata = {"input_tokens": prompt_tokens, "output_tokens": completion_tokens}
+        self.response_metadata = {"model_name": STUB_MODEL_NAME}
+
+
+def parse_latency(spec):
+    """
+    Parse a latency distribution spec into a sampler `fn(rng) -> seconds`,
+    e.g. "lognormal:0.8,0.5" for a 0.8 s median with a long right tail.
+    """
+    spec = (spec or "fixed:0").strip()
+    kind, _, args = spec.partition(":")
+    if not args:  # a bare number means fixed latency
+        kind, args = "fixed", kind
+    values = [float(v) for v in args.split(",") if v.strip()]
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal" and len(values) == 2:
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal" and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1]) if values[0] > 0 else 0.0
+    raise ValueError(f"Unsupported stub latency spec: {spec}")
+
+
+class StubConfig:
+    def __init__(self, latency=None, tokens_per_s=None, error_rate=None, rate_limit_rate=None, rpm=None, seed=None):
+        self.latency = latency if latency is not None else os.getenv("GRADER_STUB_LATENCY", "fixed:0")
+        self.tokens_per_s = float(tokens_per_s if tokens_per_s is not None else os.getenv("GRADER_STUB_TOKENS_PER_S", "0"))
+        self.error_rate = float(error_rate if error_rate is not None else os.getenv("GRADER_STUB_ERROR_RATE", "0"))
+        self.rate_limit_rate = float(rate_limit_rate if rate_limit_rate is not None else os.getenv("GRADER_STUB_429_RATE", "0"))
+        self.rpm = int(rpm if rpm is not None else os.getenv("GRADER_STUB_RPM", "0"))
+        self.seed = int(seed if seed is not None else os.getenv("GRADER_STUB_SEED", "0"))
+        self.sample_latency = parse_latency(self.latency)
+
+
+def _sentences(text):
+    return [s.strip() for s in re.split(r"(?<=[.!?])\s+|\n+", text or "") if s.strip()]
+
+
+def _topic(question):
+    words = [w for w in re.findall(r"[A-Za-z0-9-]+", question or "") if w.lower() not in _INSTRUCTION_WORDS and not w.isdigit()]
+    return " ".join(words[:6]) or "the topic"
+
+
+def _as_rubric(rubric):
+    return parse_rubric(rubric) if isinstance(rubric, str) else dict(rubric)
+
+
+def synthesize_rubric(question, marks):
+    """<start>...<end> rubric with up to five criteria whose marks sum to `marks`."""
+    marks = int(marks)
+    n = max(1, min(len(_CRITERIA_TEMPLATES), marks // 2 or 1))
+    topic = _topic(question)
+    base, extra = divmod(marks, n)
+    return format_rubric({
+        _CRITERIA_TEMPLATES[i].format(topic=topic): base + (1 if i < extra else 0)
+        for i in range(n)
+    })
+
+
+def synthesize_segments(answer, rubric):
+    """Each criterion mapped to the answer sentence sharing the most words with it, copied verbatim."""
+    sentences = _sentences(answer)
+    lines = ["<start>"]
+    for criterion in _as_rubric(rubric):
+        crit = word_stems(criterion)
+        best, overlap = None, 0
+        for sentence in sentences:
+            shared = len(crit & word_stems(sentence))
+            if shared > overlap:
+                best, overlap = sentence, shared
+        lines.append(f"Rubric: {criterion}")
+        lines.append(f"corresponding_part: {' '.join(best.split()) if best else 'Not addressed'}")
+        lines.append("####")
+    lines.append("<end>")
+    return "\n".join(lines)
+
+
+def synthesize_scores(rubric, segments):
+    """Scores proportional to criterion-word coverage of each segment, in 0.5 steps."""
+    lines = ["<start>"]
+    for criterion, max_marks in _as_rubric(rubric).items():
+        segment = (segments or {}).get(criterion, "Not addressed")
+        if not segment or segment.lower().startswith("not addressed"):
+            score = 0.0
+        else:
+            crit = word_stems(criterion)
+            coverage = len(crit & word_stems(segment)) / len(crit) if crit else 1.0
+            score = round(max_marks * min(1.0, 0.5 + coverage) * 2) / 2
+        lines.append(f"Rubric: {criterion}")
+        lines.append(f"Tentative_Score: {score}")
+        lines.append("####")
+    lines.append("<end>")
+    return "\n".join(lines)
+
+
+class StubLLM:
+    """
+    Offline LLM endpoint. Content depends only on the inputs; latency and
+    injected errors are drawn from a generator seeded by the prompt and how
+    many times it has been sent, so a run replays identically regardless of
+    thread scheduling and a retried prompt gets a fresh draw.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or StubConfig()
+        self._lock = threading.Lock()
+        self._attempts = OrderedDict()  # prompt digest -> times sent (recent prompts only)
+        self._recent = deque()  # call times inside the RPM window
+        self.stats = {"calls": 0, "errors": 0, "rate_limited": 0}
+
+    def _rng(self, prompt):
+        digest = hashlib.md5(prompt.encode("utf-8")).hexdigest()
+        with self._lock:
+            attempt = self._attempts.pop(digest, 0)
+            self._attempts[digest] = attempt + 1
+            if len(self._attempts) > 4096:  # retries follow soon after; forget old prompts
+                self._attempts.popitem(last=False)
+        return random.Random(f"{self.config.seed}:{digest}:{attempt}")
+
+    def _over_rpm(self):
+        if not self.config.rpm:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] >= 60:
+                self._recent.popleft()
+            if len(self._recent) >= self.config.rpm:
+                return 60 - (now - self._recent[0])
+            self._recent.append(now)
+        return None
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def invoke(self, prompt, stage='unspecified', **inputs):
+        """
+        Answer `prompt` for `stage`:
+            'rubric'              inputs: question, marks
+            'segmentation'        inputs: answer, rubric
+            'scoring'             inputs: rubric, segments
+            'rubric_modification' (always "No modification needed.")
+        """
+        from Token_budget import estimate_tokens
+
+        self._count("calls")
+        rng = self._rng(prompt)
+        retry_after = self._over_rpm()
+        if retry_after is not None:
+            self._count("rate_limited")
+            raise StubRateLimitError(f"stub: over {self.config.rpm} requests per minute", retry_after=retry_after)
+        draw = rng.random()
+        if draw < self.config.rate_limit_rate:
+            self._count("rate_limited")
+            time.sleep(min(0.05, self.config.sample_latency(rng)))
+            raise StubRateLimitError("stub: injected rate limit", retry_after=rng.uniform(0.1, 1.0))
+        if draw < self.config.rate_limit_rate + self.config.error_rate:
+            self._count("errors")
+            time.sleep(self.config.sample_latency(rng))
+            raise StubServerError("stub: injected server error")
+
+        if stage == 'rubric':
+            content = synthesize_rubric(inputs["question"], inputs["marks"])
+        elif stage == 'segmentation':
+            content = synthesize_segments(inputs["answer"], inputs["rubric"])
+        elif stage == 'scoring':
+            content = synthesize_scores(inputs["rubric"], inputs["segments"])
+        elif stage == 'rubric_modification':
+            content = "<start>\nNo modification needed.\n<end>"
+        else:
+            raise ValueError(f"Unsupported stub stage: {stage}")
+
+        completion_tokens = estimate_tokens(content)
+        latency = self.config.sample_latency(rng)
+        if self.config.tokens_per_s:
+            latency += completion_tokens / self.config.tokens_per_s
+        time.sleep(latency)
+        return StubResponse(content, estimate_tokens(prompt), completion_tokens)
+
+
+_stub = None
+_stub_lock = threading.Lock()
+
+
+def get_stub():
+    """Process-wide StubLLM configured from the environment."""
+    global _stub
+    with _stub_lock:
+        if _stub is None:
+            _stub = StubLLM()
+        return _stub
+
+
+def load_test(n_students=50, marks=10, max_workers=16):
+    """
+    Grades a synthetic exam end to end on the stub endpoint and prints
+    throughput, retries and token usage. Every unit is the demo answer split
+    and reshuffled per student.
+    """
+    from Automations import demo_answer
+    from Exam import ExamQuestion, grade_exam
+    from Token_budget import ledger
+
+    sentences = _sentences(demo_answer)
+    scripts = {}
+    for i in range(n_students):
+        rng = random.Random(i)
+        picked = rng.sample(sentences, rng.randint(2, len(sentences)))
+        scripts[f"student-{i:04d}"] = {"q1": " ".join(picked)}
+    question = ExamQuestion("q1", "write 10 lines on generative AI", marks, endpoint='stub', scoring_endpoint='stub')
+
+    result = grade_exam([question], scripts, max_workers=max_workers)
+    stub = get_stub()
+    print(f"Graded {len(result.units)} answers in {result.elapsed_s:.1f}s ({result.throughput():.2f} answers/s)")
+    print(f"Stub calls: {stub.stats['calls']} ({stub.stats['rate_limited']} rate-limited, {stub.stats['errors']} errors)")
+    print(f"Failed units: {len(result.errors())}")
+    print(ledger.report())
+
+
+if __name__ == "__main__":
+    # python Stub_llm.py [students] [max_workers]
+    load_test(
+        n_students=int(sys.argv[1]) if len(sys.argv) > 1 else 50,
+        max_workers=int(sys.argv[2]) if len(sys.argv) > 2 else 16,
+    )
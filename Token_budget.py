@@ -0,0 +1,184 @@
+import contextvars
+import re
+import textwrap
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("o200k_base")
+except Exception:  # tiktoken is optional; fall back to a character heuristic
+    _ENCODING = None
+
+_current_batch = contextvars.ContextVar("token_budget_batch", default=None)
+
+
+def estimate_tokens(text):
+    """Approximate token count of `text` (exact when tiktoken is installed)."""
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    return max(1, (len(text) + 3) // 4)
+
+
+def compact_text(text):
+    """Dedent a prompt, strip trailing spaces and collapse runs of blank lines."""
+    text = textwrap.dedent(text).strip()
+    text = re.sub(r"[ \t]+\n", "\n", text)
+    return re.sub(r"\n{3,}", "\n\n", text)
+
+
+def compact_rubric(rubric, with_marks=True):
+    """Serialize a rubric dict as one line per criterion instead of its Python repr."""
+    if not isinstance(rubric, dict):
+        return str(rubric).strip()
+    if with_marks:
+        return "\n".join(f"- {criterion} [{marks} marks]" for criterion, marks in rubric.items())
+    return "\n".join(f"- {criterion}" for criterion in rubric)
+
+
+def compact_segments(rubric, segments):
+    """
+    Merge rubric and extracted segments into one block, one criterion per entry.
+    Criteria missing from `segments` are listed as 'Not addressed' (the
+    scoring prompt then adds the full answer).
+    """
+    lines = []
+    for criterion, marks in rubric.items():
+        part = segments.get(criterion, "Not addressed") if segments else "Not addressed"
+        lines.append(f"Rubric: {criterion}\nMarks: {marks}\nSegment: {part}")
+    return "\n####\n".join(lines)
+
+
+class UsageLedger:
+    """
+    Thread-safe accumulator of LLM token usage and latency.
+
+    Calls are aggregated per stage ('rubric', 'segmentation', 'scoring', ...)
+    and per batch label (see `batch()`). Tokens saved by prompt compaction
+    are tracked separately per stage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stages = defaultdict(self._empty)
+            self._batches = defaultdict(self._empty)
+            self._savings = defaultdict(lambda: {"prompts": 0, "original_tokens": 0, "compact_tokens": 0})
+
+    @staticmethod
+    def _empty():
+        return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_s": 0.0, "retries": 0}
+
+    @contextmanager
+    def batch(self, name):
+        """
+        Attribute every call made inside the block to batch `name`. Worker
+        threads only see the label when started through batch_context().
+        """
+        token = _current_batch.set(name)
+        try:
+            yield
+        finally:
+            _current_batch.reset(token)
+
+    def current_batch(self):
+        return _current_batch.get()
+
+    def batch_context(self, default=None):
+        """
+        Copy of the caller's context for a worker thread (Thread target or
+        executor task), labelled with the caller's batch or else `default`.
+        Each task needs its own copy: a context can't run in two threads at once.
+        """
+        ctx = contextvars.copy_context()
+        if _current_batch.get() is None and default is not None:
+            ctx.run(_current_batch.set, default)
+        return ctx
+
+    def submit(self, executor, fn, *args, default=None):
+        """executor.submit(fn, *args) running in batch_context(default)."""
+        return executor.submit(self.batch_context(default).run, fn, *args)
+
+    def record(self, stage, prompt_tokens, completion_tokens, latency_s):
+        batch = _current_batch.get()
+        with self._lock:
+            targets = [self._stages[stage]]
+            if batch is not None:
+                targets.append(self._batches[batch])
+            for entry in targets:
+                entry["calls"] += 1
+                entry["prompt_tokens"] += prompt_tokens
+                entry["completion_tokens"] += completion_tokens
+                entry["latency_s"] += latency_s
+
+    def record_retry(self, stage):
+        """Count a retried call (rate limit or server error) for `stage` and the current batch."""
+        batch = _current_batch.get()
+        with self._lock:
+            self._stages[stage]["retries"] += 1
+            if batch is not None:
+                self._batches[batch]["retries"] += 1
+
+    def record_compaction(self, stage, original_prompt, compact_prompt):
+        with self._lock:
+            entry = self._savings[stage]
+            entry["prompts"] += 1
+            entry["original_tokens"] += estimate_tokens(original_prompt)
+            entry["compact_tokens"] += estimate_tokens(compact_prompt)
+
+    def by_stage(self):
+        with self._lock:
+            return {k: dict(v) for k, v in self._stages.items()}
+
+    def by_batch(self):
+        with self._lock:
+            return {k: dict(v) for k, v in self._batches.items()}
+
+    def savings(self):
+        with self._lock:
+            return {k: dict(v) for k, v in self._savings.items()}
+
+    def report(self):
+        """Plain-text summary of usage per stage and per batch, and tokens saved."""
+        lines = ["Stage                 calls   prompt  completion  avg latency (s)  retries"]
+        for stage, e in sorted(self.by_stage().items()):
+            avg = e["latency_s"] / e["calls"] if e["calls"] else 0.0
+            lines.append(f"{stage:<20} {e['calls']:>6} {e['prompt_tokens']:>8} {e['completion_tokens']:>11} {avg:>16.2f} {e['retries']:>8}")
+        batches = self.by_batch()
+        if batches:
+            lines.append("")
+            lines.append("Batch                 calls   prompt  completion  total latency (s)")
+            for name, e in sorted(batches.items()):
+                lines.append(f"{str(name):<20} {e['calls']:>6} {e['prompt_tokens']:>8} {e['completion_tokens']:>11} {e['latency_s']:>18.2f}")
+        savings = self.savings()
+        if savings:
+            lines.append("")
+            lines.append("Compaction            prompts  original  compact  saved")
+            for stage, e in sorted(savings.items()):
+                saved = e["original_tokens"] - e["compact_tokens"]
+                pct = 100.0 * saved / e["original_tokens"] if e["original_tokens"] else 0.0
+                lines.append(f"{stage:<20} {e['prompts']:>8} {e['original_tokens']:>9} {e['compact_tokens']:>8} {saved:>6} ({pct:.0f}%)")
+        return "\n".join(lines)
+
+
+def response_token_usage(response, prompt):
+    """
+    Extract (prompt_tokens, completion_tokens) from a LangChain chat response,
+    estimating from text when the provider did not report usage.
+    """
+    usage = getattr(response, "usage_metadata", None) or {}
+    if usage.get("input_tokens") is not None:
+        return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+    if token_usage.get("prompt_tokens") is not None:
+        return token_usage.get("prompt_tokens", 0), token_usage.get("completion_tokens", 0)
+    return estimate_tokens(prompt), estimate_tokens(getattr(response, "content", ""))
+
+
+ledger = UsageLedger()
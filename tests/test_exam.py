@@ -0,0 +1,52 @@
+import pytest
+
+# Exam imports the full pipeline (Automations -> Generative_models)
+for module in ("numpy", "torch", "transformers", "sentence_transformers", "langchain_groq", "nltk"):
+    pytest.importorskip(module)
+
+import numpy as np
+
+import Exam
+import Stub_llm
+from Answer_index import AnswerIndex
+
+RUBRIC = {
+    "Defines generative AI": 3,
+    "Describes key technologies": 3,
+    "Discusses applications and ethical concerns": 4,
+}
+ANSWER = "Generative AI creates new content. Large language models and diffusion models power it."
+
+
+def _bag_of_letters(answers):
+    vectors = np.array([[a.lower().count(c) for c in "abcdefghijklmnopqrstuvwxyz"] for a in answers], dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def scoring_calls(monkeypatch):
+    monkeypatch.setenv("GRADER_STUB_LATENCY", "fixed:0")
+    monkeypatch.setattr(Stub_llm, "_stub", None)
+    calls = []
+    score = Exam.ai_grade_segments
+
+    def counted(answer, *args, **kwargs):
+        calls.append(answer)
+        return score(answer, *args, **kwargs)
+    monkeypatch.setattr(Exam, "ai_grade_segments", counted)
+    yield calls
+    Stub_llm._stub = None
+
+
+def test_identical_answers_in_one_exam_are_scored_once(scoring_calls):
+    question = Exam.ExamQuestion("q1", "write 10 lines on generative AI", 10, rubric=RUBRIC,
+                                 endpoint='stub', scoring_endpoint='stub')
+    scripts = {"s1": {"q1": ANSWER}, "s2": {"q1": "  " + ANSWER.upper() + "\n"}}
+    index = AnswerIndex(embed_fn=_bag_of_letters)
+
+    result = Exam.ExamGrader(index=index).grade([question], scripts)
+
+    assert len(scoring_calls) == 1
+    assert not result.errors()
+    assert result.units[("s1", "q1")].scores == result.units[("s2", "q1")].scores
+    assert result.units[("s1", "q1")].scores
@@ -0,0 +1,43 @@
+import pytest
+
+for module in ("torch", "transformers", "sentence_transformers", "langchain_groq", "nltk"):
+    pytest.importorskip(module)
+
+import torch
+
+import Generative_models
+
+VECTORS = {
+    "Defines generative AI": [1.0, 0.0],
+    "Describes key technologies": [0.9, 0.1],
+    "It creates new content.": [1.0, 0.0],
+    "Transformers and diffusion models power it.": [0.0, 1.0],
+    "It learns patterns from data.": [0.5, 0.5],
+}
+
+
+class FakeCrossEncoder:
+    def predict(self, pairs, **kwargs):
+        return [1.0] * len(pairs)
+
+
+@pytest.fixture
+def fake_models(monkeypatch):
+    monkeypatch.setattr(Generative_models, "_ensure_punkt", lambda: None)
+    monkeypatch.setattr(Generative_models.nltk, "sent_tokenize", lambda text: text.split("|"))
+    monkeypatch.setattr(Generative_models, "get_sentence_model", lambda: None)
+    monkeypatch.setattr(Generative_models, "get_cross_encoder", lambda: FakeCrossEncoder())
+    monkeypatch.setattr(Generative_models, "encode_bucketed",
+                        lambda model, texts, max_tokens=None: torch.tensor([VECTORS[t] for t in texts]))
+
+
+def test_rerank_does_not_starve_later_criteria(fake_models):
+    # both criteria recall only the first sentence; the second must fall back to an unused one
+    rubric = {"Defines generative AI": 5, "Describes key technologies": 5}
+    answer = "It creates new content.|Transformers and diffusion models power it.|It learns patterns from data."
+    plain, = Generative_models.extract_relevant_passages_batch([(answer, rubric)], top_k=1)
+    reranked, = Generative_models.extract_relevant_passages_batch([(answer, rubric)], top_k=1, rerank=True, candidates=1)
+
+    assert "Not addressed" not in plain
+    assert "Not addressed" not in reranked
+    assert "It learns patterns from data." in reranked
@@ -0,0 +1,59 @@
+import pytest
+
+# grade_stream imports the full pipeline (Automations -> Generative_models)
+for module in ("numpy", "torch", "transformers", "sentence_transformers", "langchain_groq", "nltk"):
+    pytest.importorskip(module)
+
+import numpy as np
+
+import Streaming
+import Stub_llm
+
+RUBRIC = {
+    "Defines generative AI": 3,
+    "Describes key technologies": 3,
+    "Discusses applications and ethical concerns": 4,
+}
+
+
+@pytest.fixture
+def instant_stub(monkeypatch):
+    monkeypatch.setenv("GRADER_STUB_LATENCY", "fixed:0")
+    monkeypatch.setattr(Stub_llm, "_stub", None)
+    yield
+    Stub_llm._stub = None
+
+
+def test_peak_rss_flat_for_10x_corpus(instant_stub):
+    n = 500
+    kwargs = {"endpoint": 'stub', "scoring_endpoint": 'stub', "window": 32}
+    Streaming.rss_profile(n, RUBRIC, **kwargs)  # warm up imports, thread pool and allocator
+    small = Streaming.rss_profile(n, RUBRIC, **kwargs)
+    large = Streaming.rss_profile(10 * n, RUBRIC, **kwargs)
+
+    assert small["answers"] == n and large["answers"] == 10 * n
+    assert small["errors"] == 0 and large["errors"] == 0
+    growth = large["peak_rss_mib"] - small["peak_rss_mib"]
+    assert growth < max(8.0, 0.02 * small["peak_rss_mib"]), (small, large)
+
+
+def test_stream_ids_and_records(instant_stub):
+    from Answer_records import CriterionTable
+
+    answers = (f"Generative AI is a technology number {i}. It raises ethical concerns." for i in range(70))
+    table = CriterionTable()
+    results = list(Streaming.grade_stream(answers, RUBRIC, endpoint='stub', scoring_endpoint='stub',
+                                          window=16, criteria=table))
+    assert sorted(r.answer_id for r in results) == list(range(70))
+    assert all(r.error is None and r.segments is None and r.record is not None for r in results)
+    assert set(results[0].record.score_dict(table)) == set(RUBRIC)
+
+
+def test_embedding_store_grows_and_reads_back(tmp_path):
+    store = Streaming.EmbeddingStore(path=str(tmp_path / "emb.f32"), grow_rows=4)
+    first = store.append(np.ones((3, 5)))
+    second = store.append(np.arange(30, dtype=np.float32).reshape(6, 5))
+    assert (first, second, len(store)) == (0, 3, 9)
+    assert np.array_equal(store[3:9], np.arange(30, dtype=np.float32).reshape(6, 5))
+    assert np.all(store[:3] == 1)
+    store.close()